@@ -0,0 +1,98 @@
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tarfile
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy
+from netCDF4 import Dataset
+
+repo_dir = Path(__file__).resolve().parent.parent
+# Benchmarks run against the working tree, or a revision extracted by run_at_revision
+source_dir = Path(os.environ.get('SIS_BENCHMARK_SOURCE', repo_dir))
+sys.path.insert(0, str(source_dir))
+
+
+def create_arg_parser(description: str) -> ArgumentParser:
+    arg_parser = ArgumentParser(description=description)
+    arg_parser.add_argument('--rev', help='Git revision to benchmark instead of the working tree')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, of which the best is reported')
+    return arg_parser
+
+
+def run_at_revision(rev: str) -> bool:
+    # Runs the benchmark again with the source of a revision, returning whether it was run
+    if rev is None or 'SIS_BENCHMARK_SOURCE' in os.environ:
+        return False
+
+    archive = subprocess.run(['git', 'archive', '--format=tar', rev], cwd=repo_dir, check=True,
+                             stdout=subprocess.PIPE).stdout
+    with TemporaryDirectory() as rev_dir:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(rev_dir)
+        print(f'Running at revision {rev}')
+        subprocess.run([sys.executable] + sys.argv, check=True, env=dict(os.environ, SIS_BENCHMARK_SOURCE=rev_dir))
+    return True
+
+
+def create_parser_args(**kwargs) -> Namespace:
+    # The parser options of main.py, with the mappings of the benchmarked source
+    parser_args = {
+        'netcdf_mapping': str(source_dir / 'mappings' / 'netcdf' / 'imos_anmn_nrs_biogeochem.json'),
+        'json_mapping': str(source_dir / 'mappings' / 'json' / 'bom_observations_air_temp.json'),
+        'verbose': False,
+        'option': None,
+        'netcdf_cache_size': None,
+        'json_stream': False,
+    }
+    parser_args.update(kwargs)
+    return Namespace(**parser_args)
+
+
+def create_netcdf(path: Path, time_count: int, depth_count: int) -> None:
+    # An ANMN NRS biogeochemical profile, with fill values and values outside the valid range
+    rng = numpy.random.RandomState(0)
+    with Dataset(path, 'w') as dataset:
+        dataset.site_code = 'NRSDAR'
+        dataset.author = 'Benchmark Author'
+        dataset.instrument = 'SBE9'
+        dataset.geospatial_lat_min = -12.3
+        dataset.geospatial_lon_min = 130.1
+        dataset.createDimension('TIME', time_count)
+        dataset.createDimension('DEPTH', depth_count)
+
+        time_var = dataset.createVariable('TIME', 'f8', ('TIME',))
+        time_var[:] = 25000 + numpy.arange(time_count) / 24.
+        depth_var = dataset.createVariable('DEPTH', 'f4', ('DEPTH',))
+        depth_var[:] = numpy.arange(depth_count) * 0.5
+        depth_var.units = 'm'
+
+        for name, dtype in [('TEMP', 'f4'), ('PSAL', 'f8')]:
+            var = dataset.createVariable(name, dtype, ('TIME', 'DEPTH'), fill_value=99999.)
+            data = rng.uniform(-5, 40, (time_count, depth_count))
+            data[::7, ::3] = 99999.
+            var[:] = data
+            var.valid_min = -2.
+            var.valid_max = 35.
+            var.units = 'degC'
+            var.standard_name = name.lower()
+
+
+def create_json(path: Path, row_count: int) -> None:
+    # BOM weather observations, one per minute
+    rng = random.Random(1)
+    rows = [{
+        'local_date_time_full': f'202108{1 + idx // 1440 % 28:02d}{idx // 60 % 24:02d}{idx % 60:02d}00',
+        'air_temp': round(rng.uniform(-5, 40), 1),
+        'cloud': rng.choice(['-', 'Cloudy', 'Clear']),
+        'lat': -31.9,
+        'lon': 115.9,
+    } for idx in range(row_count)]
+    header = [{'ID': 'IDW60801', 'name': 'Perth', 'product_name': 'Weather Observations'}]
+    with open(path, 'w') as f:
+        json.dump({'observations': {'header': header, 'data': rows}}, f)
@@ -0,0 +1,66 @@
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List, Any, Callable
+
+import numpy
+from dateutil import parser
+
+import common
+
+
+def convert_values(field_type: str, values: List[Any]) -> List[Any]:
+    # Converts values as a template field of the given type, in bulk where the converter supports it
+    from parser.template import _compile_converter
+
+    convert = _compile_converter(field_type)
+    convert_array = getattr(convert, 'convert_array', None)
+    if convert_array is not None:
+        return list(convert_array(numpy.asarray(values)))
+    return [convert(v) for v in values]
+
+
+def benchmark(name: str, convert: Callable[[], List[Any]], expected_values: List[Any], repeat: int) -> None:
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        values = convert()
+        run_time = time.perf_counter() - start_time
+        best_time = run_time if best_time is None else min(best_time, run_time)
+    if values != expected_values:
+        raise Exception(f'Converted values differ from timedelta and dateutil for {name}')
+    print(f'{name}: {len(values)} values in {best_time:.3f}s')
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark converting datetimes to JSON')
+    arg_parser.add_argument('--count', type=int, default=100000, help='Number of values')
+    arg_parser.add_argument('--distinct-count', type=int, default=1000,
+                            help='Number of distinct timestamps when timestamps repeat')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    rng = random.Random(0)
+    json_format = '%Y-%m-%dT%H:%M:%S'
+
+    days_since_1950 = [rng.uniform(0, 30000) for _ in range(args.count)]
+    expected_values = [(datetime(1950, 1, 1) + timedelta(v)).strftime(json_format) for v in days_since_1950]
+    benchmark('days_since_1950', lambda: convert_values('datetime:days_since_1950:json', days_since_1950),
+              expected_values, args.repeat)
+
+    bom_date_time_fulls = [(datetime(2021, 1, 1) + timedelta(minutes=rng.randrange(1000000))).strftime('%Y%m%d%H%M%S')
+                           for _ in range(args.count)]
+    expected_values = [parser.parse(v).strftime(json_format) for v in bom_date_time_fulls]
+    benchmark('bom_date_time_full', lambda: convert_values('datetime:bom_date_time_full:json', bom_date_time_fulls),
+              expected_values, args.repeat)
+
+    repeated_bom_date_time_fulls = [rng.choice(bom_date_time_fulls[0:args.distinct_count]) for _ in range(args.count)]
+    expected_values = [parser.parse(v).strftime(json_format) for v in repeated_bom_date_time_fulls]
+    benchmark(f'bom_date_time_full, {args.distinct_count} distinct',
+              lambda: convert_values('datetime:bom_date_time_full:json', repeated_bom_date_time_fulls),
+              expected_values, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
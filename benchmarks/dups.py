@@ -0,0 +1,101 @@
+import random
+import time
+from pathlib import Path
+from typing import List, Dict, Any
+
+import common
+
+key_fields = ['site_code', 'date', 'program', 'variant_type', 'variant_date_time', 'variant_value', 'variant_comment',
+              'parameter']
+
+
+# The original nested loop implementation of ignore_zero_dups and ignore_dups
+def ignore_dups_nested(imports: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    from parser import BaseParser
+
+    def is_zero_model(mdl: Dict[str, Any]):
+        return float(mdl['value']) == 0. and float(mdl['variant_value']) == 0.
+
+    zero_dup_idxs = set()
+    for idx_a, mdl_a in enumerate(imports):
+        for idx_b, mdl_b in enumerate(imports[:idx_a]):
+            if BaseParser._compare_models(mdl_a, mdl_b):
+                if is_zero_model(mdl_a):
+                    zero_dup_idxs.add(idx_a)
+                if is_zero_model(mdl_b):
+                    zero_dup_idxs.add(idx_b)
+    imports = [mdl for idx, mdl in enumerate(imports) if idx not in zero_dup_idxs]
+
+    dup_idxs = set()
+    for idx_a, mdl_a in enumerate(imports):
+        for idx_b, mdl_b in enumerate(imports[:idx_a]):
+            if BaseParser._compare_models(mdl_a, mdl_b):
+                dup_idxs.add(idx_b)
+    return [mdl for idx, mdl in enumerate(imports) if idx not in dup_idxs]
+
+
+def create_imports(rng: random.Random, count: int) -> List[Dict[str, Any]]:
+    # A third as many dates as imports, so about a third of the imports are duplicates
+    date_count = max(count // 3, 1)
+    return [{
+        'site_code': rng.choice(['A', 'B']),
+        'date': str(rng.randrange(date_count)),
+        'program': 'P',
+        'variant_type': 'depth',
+        'variant_date_time': '',
+        'variant_value': rng.choice(['0.0', '1.5', '0']),
+        'variant_comment': '',
+        'parameter': rng.choice(['TEMP', 'PSAL']),
+        'value': rng.choice(['0', '0.0', '2']),
+        'comment': str(idx),
+    } for idx in range(count)]
+
+
+def ignore_dups(imports: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    import parser
+    from parser import BaseParser
+
+    m_parser = BaseParser(Path('benchmark'))
+    if hasattr(parser, 'ParsedImports'):
+        m_parser._imports = parser.ParsedImports(key_fields + ['value', 'comment'])
+        for mdl in imports:
+            m_parser._imports.append(mdl)
+    else:
+        m_parser._imports = list(imports)
+    m_parser._ignore_zero_dups()
+    m_parser._ignore_dups()
+    return list(m_parser._imports)
+
+
+def benchmark(name: str, ignore: Any, imports: List[Dict[str, Any]], repeat: int) -> List[Dict[str, Any]]:
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = ignore(imports)
+        run_time = time.perf_counter() - start_time
+        best_time = run_time if best_time is None else min(best_time, run_time)
+    print(f'{name}: {len(imports)} imports, {len(imports) - len(result)} duplicates in {best_time:.2f}s')
+    return result
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark ignoring duplicate imports')
+    arg_parser.add_argument('--counts', type=int, nargs='+', default=[10000, 100000, 1000000],
+                            help='Numbers of imports')
+    arg_parser.add_argument('--nested-max-count', type=int, default=10000,
+                            help='Largest number of imports to compare with the nested loop implementation')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    rng = random.Random(0)
+    for count in args.counts:
+        imports = create_imports(rng, count)
+        result = benchmark('ignore_dups', ignore_dups, imports, args.repeat)
+        if count <= args.nested_max_count:
+            if result != benchmark('nested', ignore_dups_nested, imports, 1):
+                raise Exception(f'Imports differ from the nested loop implementation for {count} imports')
+
+
+if __name__ == '__main__':
+    main()
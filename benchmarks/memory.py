@@ -0,0 +1,37 @@
+import gc
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import common
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark the memory used by parsed imports')
+    arg_parser.add_argument('--netcdf-times', type=int, default=5000, help='Number of NetCDF times')
+    arg_parser.add_argument('--netcdf-depths', type=int, default=20, help='Number of NetCDF depths per time')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    from parser.netcdf import NetcdfParser
+
+    with TemporaryDirectory() as data_dir:
+        netcdf_path = Path(data_dir) / 'profile.nc'
+        common.create_netcdf(netcdf_path, args.netcdf_times, args.netcdf_depths)
+
+        # Memory still allocated once the parser is gone is held by the imports
+        gc.collect()
+        tracemalloc.start()
+        m_parser = NetcdfParser(netcdf_path)
+        imports = m_parser.start_silent(common.create_parser_args())
+        del m_parser
+        gc.collect()
+        size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f'{len(imports)} imports: {size / 1e6:.1f} MB held, {peak_size / 1e6:.1f} MB peak while parsing')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import common
+
+
+def benchmark_parser(parser_type: type, path: Path, repeat: int) -> None:
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        imports = parser_type(path).start_silent(common.create_parser_args())
+        run_time = time.perf_counter() - start_time
+        best_time = run_time if best_time is None else min(best_time, run_time)
+    print(f'{parser_type.__name__}: {len(imports)} imports in {best_time:.2f}s = {len(imports) / best_time:.0f} rows/s')
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark parsing NetCDF and JSON files into imports')
+    arg_parser.add_argument('--netcdf-times', type=int, default=1000, help='Number of NetCDF times')
+    arg_parser.add_argument('--netcdf-depths', type=int, default=20, help='Number of NetCDF depths per time')
+    arg_parser.add_argument('--json-rows', type=int, default=20000, help='Number of JSON rows')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    from parser.json import JsonParser
+    from parser.netcdf import NetcdfParser
+
+    with TemporaryDirectory() as data_dir:
+        netcdf_path = Path(data_dir) / 'profile.nc'
+        common.create_netcdf(netcdf_path, args.netcdf_times, args.netcdf_depths)
+        benchmark_parser(NetcdfParser, netcdf_path, args.repeat)
+
+        json_path = Path(data_dir) / 'observations.json'
+        common.create_json(json_path, args.json_rows)
+        benchmark_parser(JsonParser, json_path, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
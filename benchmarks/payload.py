@@ -0,0 +1,41 @@
+import json
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import common
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark the size of the check and run payloads sent for each batch')
+    arg_parser.add_argument('--netcdf-times', type=int, default=5000, help='Number of NetCDF times')
+    arg_parser.add_argument('--netcdf-depths', type=int, default=20, help='Number of NetCDF depths per time')
+    arg_parser.add_argument('--batch-size', type=int, default=1000, help='Number of imports per batch')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    from parser.netcdf import NetcdfParser
+    from splashback import SplashbackImporter
+
+    with TemporaryDirectory() as data_dir:
+        netcdf_path = Path(data_dir) / 'profile.nc'
+        common.create_netcdf(netcdf_path, args.netcdf_times, args.netcdf_depths)
+        imports = NetcdfParser(netcdf_path).start_silent(common.create_parser_args())
+
+    payload_sizes = []
+    encode_time = 0.
+    for offset in range(0, len(imports), args.batch_size):
+        payload = SplashbackImporter._get_payload(imports[offset:offset + args.batch_size])
+        start_time = time.perf_counter()
+        payload_sizes.append(len(json.dumps(payload).encode()))
+        encode_time += time.perf_counter() - start_time
+
+    print(f'{len(imports)} imports in {len(payload_sizes)} batches: '
+          f'{sum(payload_sizes) / len(payload_sizes) / 1024:.1f} KiB per batch, '
+          f'{sum(payload_sizes) / 1e6:.1f} MB total, encoded in {encode_time:.2f}s')
+    print(f'First import: value {imports[0]["value"]}, variant_value {imports[0]["variant_value"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import time
+from typing import List, Dict, Any
+
+import common
+
+unique_fields = ['name', 'location']
+
+
+def match_metadata(local_metadata: List[Dict[str, Any]], remote_metadata: List[Dict[str, Any]]) -> List[Any]:
+    # Collects the unique local metadata and finds each in the remote metadata, as create_metadata does
+    import listutils
+
+    if hasattr(listutils, 'UniqueList'):
+        unique_local = listutils.UniqueList(unique_fields, local_metadata)
+        unique_remote = listutils.UniqueList(unique_fields, remote_metadata)
+        return [unique_remote.get(value) for value in unique_local]
+
+    unique_local = []
+    for value in local_metadata:
+        listutils.add_unique_to_list(unique_local, unique_fields, value)
+    return [listutils.get_unique_value(remote_metadata, unique_fields, value) for value in unique_local]
+
+
+def main():
+    arg_parser = common.create_arg_parser('Benchmark matching local metadata to remote metadata')
+    arg_parser.add_argument('--remote-counts', type=int, nargs='+', default=[20000, 50000],
+                            help='Numbers of remote entities')
+    arg_parser.add_argument('--local-ratio', type=float, default=0.1,
+                            help='Number of local entities relative to remote entities')
+    args = arg_parser.parse_args()
+    if common.run_at_revision(args.rev):
+        return
+
+    for remote_count in args.remote_counts:
+        # Half of the local entities are already remote, and each is added once per message of 3
+        local_count = int(remote_count * args.local_ratio)
+        remote_metadata = [{'name': f'site {idx}', 'location': f'location {idx}', 'id': idx}
+                           for idx in range(remote_count)]
+        local_metadata = [{'name': f'site {idx}', 'location': f'location {idx}'}
+                          for idx in range(remote_count - local_count // 2, remote_count + local_count // 2)] * 3
+
+        best_time = None
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            matches = match_metadata(local_metadata, remote_metadata)
+            run_time = time.perf_counter() - start_time
+            best_time = run_time if best_time is None else min(best_time, run_time)
+        match_count = sum(1 for m in matches if m is not None)
+        print(f'{remote_count} remote, {local_count} local: {match_count} matched in {best_time:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
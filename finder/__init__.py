@@ -1,6 +1,6 @@
 from argparse import Namespace
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
 
 class BaseFinder:
@@ -12,3 +12,11 @@ class BaseFinder:
 
     def start_silent(self, args: Namespace) -> List[Path]:
         raise NotImplementedError()
+
+    def iter_silent(self, args: Namespace) -> Iterator[Path]:
+        # Yield paths as they become available, finders that download many files should override this
+        yield from self.start_silent(args)
+
+    def complete_path(self, path: Path) -> None:
+        # Called once every import from a path has been imported
+        pass
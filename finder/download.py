@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from argparse import Namespace
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock, Semaphore
+from typing import Callable, Dict, List, TypeVar, Union, Any
+from urllib.parse import urlparse
+
+import requests
+
+T = TypeVar('T')
+
+default_chunk_size = 1024 * 1024
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# A cache of downloaded files shared by every run, stored by the hash of their content so files with the same content
+# are only stored once. The least recently used files are removed once the cache is larger than its maximum size.
+class DownloadCache:
+    def __init__(self, cache_dir: Path, max_size: Union[int, None] = None):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._lock = Lock()
+        self._index_path = cache_dir.joinpath('index.json')
+        # Content hash, size, access time and validators of each cached URL
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if self._index_path.exists():
+            with self._index_path.open('r') as f:
+                self._entries = json.load(f)
+
+        self.hits = 0
+        self.misses = 0
+
+    def _get_object_path(self, content_hash: str) -> Path:
+        return self._cache_dir.joinpath('objects', content_hash[0:2], content_hash)
+
+    def restore(self, url: str, path: Path, validators_path: Path) -> bool:
+        # Copy the cached file of a URL to the path, returning whether it was cached
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or not self._get_object_path(entry['hash']).exists():
+                self.misses += 1
+                return False
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _link_or_copy(self._get_object_path(entry['hash']), path)
+            with validators_path.open('w') as f:
+                json.dump({'etag': entry['etag'], 'last_modified': entry['last_modified']}, f)
+
+            entry['accessed'] = time.time()
+            self.hits += 1
+            self._save()
+            return True
+
+    def add(self, url: str, path: Path, validators: Dict[str, Union[str, None]]) -> None:
+        content_hash = hashlib.sha256()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+        content_hash = content_hash.hexdigest()
+
+        with self._lock:
+            object_path = self._get_object_path(content_hash)
+            if not object_path.exists():
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = object_path.with_name(object_path.name + '.tmp')
+                _link_or_copy(path, tmp_path)
+                tmp_path.replace(object_path)
+
+            self._entries[url] = {'hash': content_hash, 'size': object_path.stat().st_size, 'accessed': time.time(),
+                                  'etag': validators.get('etag'), 'last_modified': validators.get('last_modified')}
+            self._evict()
+            self._save()
+
+    def _evict(self) -> None:
+        if self._max_size is None:
+            return
+
+        # Find when each stored file was last used
+        object_sizes: Dict[str, int] = {}
+        object_accessed: Dict[str, float] = {}
+        for entry in self._entries.values():
+            object_sizes[entry['hash']] = entry['size']
+            object_accessed[entry['hash']] = max(object_accessed.get(entry['hash'], 0.), entry['accessed'])
+
+        # Remove the least recently used files until the cache fits
+        size = sum(object_sizes.values())
+        for content_hash in sorted(object_accessed, key=lambda h: object_accessed[h]):
+            if size <= self._max_size:
+                break
+            self._get_object_path(content_hash).unlink(missing_ok=True)
+            self._entries = {u: e for u, e in self._entries.items() if e['hash'] != content_hash}
+            size -= object_sizes[content_hash]
+
+    def _save(self) -> None:
+        tmp_path = self._index_path.with_name(self._index_path.name + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(self._entries, f)
+        tmp_path.replace(self._index_path)
+
+    def __str__(self) -> str:
+        return f'Download cache: {self.hits} hits, {self.misses} misses'
+
+
+def create_download_cache(args: Namespace) -> Union[DownloadCache, None]:
+    if args.cache_dir is None:
+        return None
+
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return DownloadCache(cache_dir, None if args.cache_size is None else args.cache_size * 1024 * 1024)
+
+
+def download_file(url: str, path: Path, chunk_size: int = default_chunk_size, refresh: bool = False,
+                  headers: Dict[str, str] = None, cache: DownloadCache = None) -> Path:
+    # Downloads are written to a part file and only renamed to the path once complete,
+    # so an existing path is always a complete download
+    if path.exists() and not refresh:
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(path.name + '.part')
+    # The ETag and Last-Modified headers of the part file, or of the path once complete
+    validators_path = path.with_name(path.name + '.validators.json')
+
+    # Use a cached download, which is still checked with the server when refreshing.
+    # The validators are now those of the restored path, so an older part file can't be resumed with them
+    if cache is not None and not path.exists() and cache.restore(url, path, validators_path):
+        part_path.unlink(missing_ok=True)
+        if not refresh:
+            return path
+    validators = {}
+    if validators_path.exists():
+        with validators_path.open('r') as f:
+            validators = json.load(f)
+    validator = validators.get('etag') or validators.get('last_modified')
+
+    request_headers = dict(headers or {})
+    resume_size = 0
+    if part_path.exists() and validator is not None:
+        # Resume the part file, unless the file has changed on the server since it was started
+        resume_size = part_path.stat().st_size
+        request_headers['Range'] = f'bytes={resume_size}-'
+        request_headers['If-Range'] = validator
+    elif path.exists():
+        # Only download the file again if it has changed on the server
+        if validators.get('etag') is not None:
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified') is not None:
+            request_headers['If-Modified-Since'] = validators['last_modified']
+
+    with requests.get(url, stream=True, headers=request_headers) as r:
+        if r.status_code == 304:
+            return path
+        if r.status_code == 416 or (r.status_code == 206 and
+                                    not r.headers.get('Content-Range', '').startswith(f'bytes {resume_size}-')):
+            # The part file can't be resumed, so start again
+            part_path.unlink()
+            return download_file(url, path, chunk_size=chunk_size, refresh=refresh, headers=headers, cache=cache)
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            resume_size = 0
+            validators = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+            with validators_path.open('w') as f:
+                json.dump(validators, f)
+
+        with part_path.open('ab' if resume_size > 0 else 'wb') as file:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+
+    part_path.replace(path)
+    if cache is not None:
+        cache.add(url, path, validators)
+    return path
+
+
+class DownloadPool:
+    def __init__(self, workers: int = 1, host_workers: Union[int, None] = None):
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._host_workers = host_workers
+        self._host_semaphores: Dict[str, Semaphore] = {}
+        self._lock = Lock()
+        self._futures: List[Future] = []
+
+    def __enter__(self) -> 'DownloadPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        # Don't start queued downloads if one has failed
+        if exc_type is not None:
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _get_host_semaphore(self, url: str) -> Union[Semaphore, None]:
+        if self._host_workers is None:
+            return None
+
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = Semaphore(self._host_workers)
+            return self._host_semaphores[host]
+
+    def submit(self, url: str, fn: Callable[..., T], *args) -> Future:
+        host_semaphore = self._get_host_semaphore(url)
+
+        def download() -> T:
+            if host_semaphore is None:
+                return fn(*args)
+            with host_semaphore:
+                return fn(*args)
+
+        future = self._executor.submit(download)
+        self._futures.append(future)
+        return future
@@ -6,6 +6,7 @@ from typing import List
 import requests
 
 from finder import BaseFinder
+from finder.download import create_download_cache, download_file
 
 
 class RequestFinder(BaseFinder):
@@ -19,23 +20,17 @@ class RequestFinder(BaseFinder):
         # TODO: Remove! Use FTP for BOM data...
         headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:90.0) Gecko/20100101 Firefox/90.0'}
 
-        with requests.get(args.request_url, stream=True, headers=headers) as r:
-            r.raise_for_status()
-
-            file_name = args.request_url.split('/')[-1]
-            if '.' not in file_name:
+        file_name = args.request_url.split('/')[-1]
+        if '.' not in file_name:
+            # Find the file extension from the content type
+            with requests.get(args.request_url, stream=True, headers=headers) as r:
+                r.raise_for_status()
                 file_ext = guess_extension(r.headers['content-type'])
                 file_name = file_name + '.' + file_ext
-            path = self._app_dir.joinpath(file_name)
-
-            if path.exists():
-                # TODO: handle last modified date to update old datasets.
-                #  we will also need to delete data from Splashback in the old dataset...
-                return [path]
-
-            path.parent.mkdir(parents=True, exist_ok=True)
+        path = self._app_dir.joinpath(file_name)
 
-            with path.open('wb') as file:
-                for chunk in r.iter_content(chunk_size=8192):
-                    file.write(chunk)
+        # TODO: handle last modified date to update old datasets.
+        #  we will also need to delete data from Splashback in the old dataset...
+        download_file(args.request_url, path, chunk_size=args.download_chunk_size * 1024,
+                      refresh=args.download_refresh, headers=headers, cache=create_download_cache(args))
         return [path]
@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import json
+import os
 import re
 import sys
+import time
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
-from typing import Union, List
+from threading import Lock
+from typing import Union, List, Dict, Tuple, Any, Callable, Iterator, Deque
 from xml.etree import ElementTree
 
 import requests
 
 from finder import BaseFinder
+from finder.download import DownloadCache, DownloadPool, create_download_cache, default_chunk_size, download_file
 
 namespaces = {'': 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'}
 
@@ -21,6 +28,10 @@ server_host = 'http://thredds.aodn.org.au'
 class ThreddsFinder(BaseFinder):
     def __init__(self, app_dir: Path):
         super().__init__(app_dir)
+        self._crawl_stats: Union[ThreddsCrawlStats, None] = None
+        self._sync_state: Union[ThreddsSyncState, None] = None
+        self._sync_datasets: Dict[Path, ThreddsDataset] = {}
+        self._download_cache: Union[DownloadCache, None] = None
 
     def start_interactive(self) -> List[Path]:
         print('Connecting to', server_host, '...')
@@ -110,8 +121,14 @@ class ThreddsFinder(BaseFinder):
         return path
 
     def start_silent(self, args: Namespace) -> List[Path]:
-        # Load THREDDS server
-        thredds_server = ThreddsServer(server_host)
+        return list(self.iter_silent(args))
+
+    def iter_silent(self, args: Namespace) -> Iterator[Path]:
+        # Load THREDDS server, using catalogs cached by previous runs
+        thredds_cache = ThreddsCatalogCache(self._app_dir.joinpath('.thredds_catalogs.json'), args.thredds_cache_ttl)
+        thredds_server = ThreddsServer(server_host, cache=thredds_cache)
+
+        self._download_cache = create_download_cache(args)
 
         # Get THREDDS service
         thredds_service = thredds_server.find_service(args.thredds_service)
@@ -120,34 +137,230 @@ class ThreddsFinder(BaseFinder):
 
         if args.thredds_dataset_pattern:
             # Find THREDDS datasets
-            thredds_datasets: List[ThreddsDataset] = self._find_datasets(thredds_server.catalog, args.thredds_dataset)
-
-            # Open THREDDS datasets and return paths
-            return [thredds_dataset.download(thredds_service, self._app_dir) for thredds_dataset in thredds_datasets]
+            thredds_datasets: List[ThreddsDataset] = self._find_datasets(thredds_server.catalog, args.thredds_dataset,
+                                                                         workers=args.thredds_crawl_workers)
+            thredds_cache.save()
+            if args.verbose:
+                print(self._crawl_stats)
+                print(thredds_cache)
+
+            # Only import new and changed datasets, by comparing them to the datasets imported by earlier runs
+            if args.thredds_incremental:
+                self._sync_state = ThreddsSyncState(self._app_dir.joinpath(f'.thredds_sync_{args.pool_id}.jsonl'))
+                changed_datasets = [d for d in thredds_datasets if self._sync_state.is_changed(d)]
+                if args.verbose:
+                    print(f'Skipped {len(thredds_datasets) - len(changed_datasets)} unchanged datasets')
+                thredds_datasets = changed_datasets
+
+            # Open THREDDS datasets and yield paths in the order they were found,
+            # only downloading a few datasets ahead of the caller
+            download_window = max(args.download_workers, 1) * 2
+            with DownloadPool(args.download_workers, args.download_host_workers) as download_pool:
+                futures: Deque[Future] = deque()
+                for thredds_dataset in thredds_datasets:
+                    futures.append(download_pool.submit(thredds_dataset.get_url(thredds_service),
+                                                        self._download, thredds_dataset, thredds_service, args))
+                    if len(futures) >= download_window:
+                        yield futures.popleft().result()
+                while len(futures) > 0:
+                    yield futures.popleft().result()
+
+            if args.verbose and self._download_cache is not None:
+                print(self._download_cache)
+            return
 
         # Open THREDDS dataset and return path
+        thredds_cache.save()
         thredds_dataset = ThreddsDataset(thredds_server, args.thredds_dataset)
-        return [thredds_dataset.download(thredds_service, self._app_dir)]
+        yield thredds_dataset.download(thredds_service, self._app_dir, refresh=args.download_refresh,
+                                       chunk_size=args.download_chunk_size * 1024, cache=self._download_cache)
+
+    def _download(self, thredds_dataset: ThreddsDataset, thredds_service: ThreddsService, args: Namespace) -> Path:
+        chunk_size = args.download_chunk_size * 1024
+        if self._sync_state is None:
+            return thredds_dataset.download(thredds_service, self._app_dir, refresh=args.download_refresh,
+                                            chunk_size=chunk_size, cache=self._download_cache)
+
+        # Refresh downloads of changed datasets
+        refresh = args.download_refresh or self._sync_state.is_known(thredds_dataset)
+        path = thredds_dataset.download(thredds_service, self._app_dir, refresh=refresh, chunk_size=chunk_size,
+                                        cache=self._download_cache)
+        self._sync_datasets[path] = thredds_dataset
+        return path
+
+    def complete_path(self, path: Path) -> None:
+        thredds_dataset = self._sync_datasets.pop(path, None)
+        if thredds_dataset is not None:
+            self._sync_state.add(thredds_dataset)
+
+    def _find_datasets(self, thredds_catalog: ThreddsCatalog, pattern: str, workers: int = 1) \
+            -> List[ThreddsDataset]:
+        self._crawl_stats = ThreddsCrawlStats()
+        crawl_start = time.perf_counter()
+
+        # Load catalogs breadth-first, loading each matching child as soon as its parent has loaded
+        matches: Dict[ThreddsCatalog, Tuple[List[ThreddsCatalog], List[ThreddsDataset]]] = {}
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            pending = {executor.submit(self._load_catalog, thredds_catalog): (thredds_catalog, 0)}
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    catalog, depth = pending.pop(future)
+                    self._crawl_stats.add_load(depth, future.result())
 
-    def _find_datasets(self, thredds_catalog: ThreddsCatalog, pattern: str, depth: int = 0) -> List[ThreddsDataset]:
-        thredds_datasets: List[ThreddsDataset] = []
+                    re_pattern = re.compile('/'.join(pattern.split('/')[0:depth + 1]))
+
+                    matching_catalogs = [c for c in catalog.children if re_pattern.fullmatch(c.id) is not None]
+                    matching_datasets = [d for d in catalog.datasets if re_pattern.fullmatch(d.id) is not None]
+                    matches[catalog] = (matching_catalogs, matching_datasets)
+
+                    for matching_catalog in matching_catalogs:
+                        pending[executor.submit(self._load_catalog, matching_catalog)] = (matching_catalog, depth + 1)
+
+        self._crawl_stats.elapsed = time.perf_counter() - crawl_start
+
+        # Collect datasets depth-first, so they are in the same order regardless of load order
+        def collect_datasets(catalog: ThreddsCatalog) -> List[ThreddsDataset]:
+            matching_catalogs, matching_datasets = matches[catalog]
+            return [d for c in matching_catalogs for d in collect_datasets(c)] + matching_datasets
+
+        return collect_datasets(thredds_catalog)
+
+    @staticmethod
+    def _load_catalog(thredds_catalog: ThreddsCatalog) -> float:
+        load_start = time.perf_counter()
         thredds_catalog.load()
+        return time.perf_counter() - load_start
 
-        re_pattern = re.compile('/'.join(pattern.split('/')[0:depth + 1]))
+    @property
+    def crawl_stats(self) -> Union[ThreddsCrawlStats, None]:
+        return self._crawl_stats
 
-        matching_catalogs = [c for c in thredds_catalog.children if re_pattern.fullmatch(c.id) is not None]
-        for matching_catalog in matching_catalogs:
-            thredds_datasets += self._find_datasets(matching_catalog, pattern, depth + 1)
 
-        matching_datasets = [d for d in thredds_catalog.datasets if re_pattern.fullmatch(d.id) is not None]
-        thredds_datasets += matching_datasets
+class ThreddsCrawlStats:
+    def __init__(self):
+        self.elapsed = 0.
+        self.depth_counts: Dict[int, int] = {}
+        self.depth_load_times: Dict[int, float] = {}
 
-        return thredds_datasets
+    @property
+    def count(self) -> int:
+        return sum(self.depth_counts.values())
+
+    def add_load(self, depth: int, load_time: float) -> None:
+        self.depth_counts[depth] = self.depth_counts.get(depth, 0) + 1
+        self.depth_load_times[depth] = self.depth_load_times.get(depth, 0.) + load_time
+
+    def __str__(self) -> str:
+        depths = ', '.join(f'depth {depth}: {count} in {self.depth_load_times[depth]:.2f}s'
+                           for depth, count in sorted(self.depth_counts.items()))
+        return f'Loaded {self.count} catalogs in {self.elapsed:.2f}s ({depths})'
+
+
+class ThreddsCatalogCache:
+    def __init__(self, path: Path, ttl: float = 0.):
+        self._path = path
+        self._ttl = ttl
+        self._lock = Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            # A corrupt cache is only a slower crawl, so start with an empty cache
+            try:
+                with path.open('r') as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                self._entries = {}
+
+        # Counts are updated by crawl threads, so only while holding the lock
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def get(self, url: str) -> Union[Dict[str, Any], None]:
+        with self._lock:
+            return self._entries.get(url)
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry['fetched'] < self._ttl
+
+    def hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def put(self, url: str, data: Dict[str, Any], etag: Union[str, None], last_modified: Union[str, None]) -> None:
+        with self._lock:
+            self._entries[url] = {'fetched': time.time(), 'etag': etag, 'last_modified': last_modified, 'data': data}
+            self.misses += 1
+
+    def revalidate(self, url: str) -> None:
+        with self._lock:
+            self._entries[url]['fetched'] = time.time()
+            self.revalidations += 1
+
+    def save(self) -> None:
+        with self._lock:
+            tmp_path = self._path.with_name(self._path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(self._entries, f)
+            tmp_path.replace(self._path)
+
+    def __str__(self) -> str:
+        return f'Catalog cache: {self.hits} hits, {self.revalidations} revalidated, {self.misses} fetched'
+
+
+# An append-only record of the date and size of each imported dataset, so unchanged datasets can be skipped
+class ThreddsSyncState:
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            complete_size = 0
+            with path.open('rb') as f:
+                for line in f:
+                    # An entry without a newline was being written when interrupted
+                    if not line.endswith(b'\n'):
+                        break
+                    complete_size += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._entries[entry['id']] = entry
+
+            # Remove the interrupted entry, so the next entry isn't appended to it
+            if complete_size < path.stat().st_size:
+                os.truncate(path, complete_size)
+
+    @staticmethod
+    def _get_entry(dataset: ThreddsDataset) -> Dict[str, Any]:
+        return {'id': dataset.id, 'date': dataset.date.isoformat(), 'size': dataset.size,
+                'size_units': dataset.size_units}
+
+    def is_known(self, dataset: ThreddsDataset) -> bool:
+        with self._lock:
+            return dataset.id in self._entries
+
+    def is_changed(self, dataset: ThreddsDataset) -> bool:
+        with self._lock:
+            return self._entries.get(dataset.id) != self._get_entry(dataset)
+
+    def add(self, dataset: ThreddsDataset) -> None:
+        entry = self._get_entry(dataset)
+        with self._lock:
+            self._entries[dataset.id] = entry
+
+            # Flush each entry to disk, so imported datasets aren't imported again after a crash
+            with self._path.open('a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
 
 
 class ThreddsServer:
-    def __init__(self, host: str):
+    def __init__(self, host: str, cache: ThreddsCatalogCache = None):
         self._host = host
+        self._cache = cache
         self._services = []
         self._load()
 
@@ -155,18 +368,52 @@ class ThreddsServer:
         r = requests.get(self._host + path)
         return ElementTree.fromstring(r.content)
 
+    def get_catalog(self, path: str, parse_xml: Callable[[ElementTree.Element], Dict[str, Any]]) -> Dict[str, Any]:
+        if self._cache is None:
+            return parse_xml(self.get_xml(path))
+
+        # Use cached catalog within its TTL, otherwise revalidate it
+        url = self._host + path
+        entry = self._cache.get(url)
+        headers = {}
+        if entry is not None:
+            if self._cache.is_fresh(entry):
+                self._cache.hit()
+                return entry['data']
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = requests.get(url, headers=headers)
+        if entry is not None and r.status_code == 304:
+            self._cache.revalidate(url)
+            return entry['data']
+        r.raise_for_status()
+
+        data = parse_xml(ElementTree.fromstring(r.content))
+        self._cache.put(url, data, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return data
+
     def _load(self) -> None:
-        root_xml = self.get_xml('/thredds/catalog/catalog.xml')
-        self._name = root_xml.get('name')
-        self._version = root_xml.get('version')
+        root_data = self.get_catalog('/thredds/catalog/catalog.xml', self._parse_xml)
+        self._name = root_data['name']
+        self._version = root_data['version']
 
-        for service_xml in root_xml.findall('./service/service', namespaces=namespaces):
-            name = service_xml.get('name')
-            base = service_xml.get('base')
+        for name, base in root_data['services']:
             self._services.append(ThreddsService(self, name, base))
 
         self._catalog = ThreddsCatalog(self, '')
 
+    @staticmethod
+    def _parse_xml(root_xml: ElementTree.Element) -> Dict[str, Any]:
+        return {
+            'name': root_xml.get('name'),
+            'version': root_xml.get('version'),
+            'services': [[service_xml.get('name'), service_xml.get('base')]
+                         for service_xml in root_xml.findall('./service/service', namespaces=namespaces)],
+        }
+
     @property
     def host(self) -> str:
         return self._host
@@ -248,22 +495,29 @@ class ThreddsCatalog(ThreddsServerAccessor):
         return self._id
 
     def load(self) -> None:
-        self._children = []
-        self._datasets = []
+        catalog_data = self.server.get_catalog('/thredds/catalog/' + self._id + '/catalog.xml', self._parse_xml)
 
-        root_xml = self.server.get_xml('/thredds/catalog/' + self._id + '/catalog.xml')
+        self._children = [ThreddsCatalog(self.server, catalog_id, parent=self)
+                          for catalog_id in catalog_data['children']]
+        self._datasets = [ThreddsDataset(self.server, dataset_id, dataset_size, dataset_size_units,
+                                         datetime.fromisoformat(dataset_date))
+                          for dataset_id, dataset_size, dataset_size_units, dataset_date in catalog_data['datasets']]
 
+    @staticmethod
+    def _parse_xml(root_xml: ElementTree.Element) -> Dict[str, Any]:
+        children = []
         for catalogRef_xml in root_xml.findall('.//catalogRef', namespaces=namespaces):
-            catalog_id = catalogRef_xml.get('ID')
-            self._children.append(ThreddsCatalog(self.server, catalog_id, parent=self))
+            children.append(catalogRef_xml.get('ID'))
 
+        datasets = []
         for dataset_xml in root_xml.findall('./dataset/dataset', namespaces=namespaces):
             dataset_id = dataset_xml.get('ID')
             dataset_size = float(dataset_xml.find('dataSize', namespaces=namespaces).text)
             dataset_size_units = dataset_xml.find('dataSize', namespaces=namespaces).get('units')
-            dataset_date = datetime.fromisoformat(dataset_xml.find('date', namespaces=namespaces).text[0:-1])
-            self._datasets.append(
-                ThreddsDataset(self.server, dataset_id, dataset_size, dataset_size_units, dataset_date))
+            dataset_date = dataset_xml.find('date', namespaces=namespaces).text[0:-1]
+            datasets.append([dataset_id, dataset_size, dataset_size_units, dataset_date])
+
+        return {'children': children, 'datasets': datasets}
 
 
 class ThreddsDataset(ThreddsServerAccessor):
@@ -291,19 +545,12 @@ class ThreddsDataset(ThreddsServerAccessor):
     def date(self) -> datetime:
         return self._date
 
-    def download(self, service: ThreddsService, dest_dir: Path) -> Path:
-        path = dest_dir.joinpath(self.id)
+    def get_url(self, service: ThreddsService) -> str:
+        return self.server.host + service.base + self.id
 
-        if path.exists():
-            # TODO: handle last modified date to update old datasets.
-            #  we will also need to delete data from Splashback in the old dataset...
-            return path
-
-        path.parent.mkdir(parents=True, exist_ok=True)
-
-        with path.open('wb') as file:
-            with requests.get(self.server.host + service.base + self.id, stream=True) as r:
-                r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=8192):
-                    file.write(chunk)
-        return path
+    def download(self, service: ThreddsService, dest_dir: Path, refresh: bool = False,
+                 chunk_size: int = default_chunk_size, cache: DownloadCache = None) -> Path:
+        # TODO: handle last modified date to update old datasets.
+        #  we will also need to delete data from Splashback in the old dataset...
+        return download_file(self.get_url(service), dest_dir.joinpath(self.id), chunk_size=chunk_size, refresh=refresh,
+                             cache=cache)
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Tuple, Any, Union
+
+
+# An append-only record of the imported segments of each path, so an interrupted import can be resumed.
+# Paths are identified by a hash of their content and the settings they were parsed with, so changed paths are
+# imported again. Segments are imported in order, so only the number of imports completed from each path is kept.
+class ImportJournal:
+    def __init__(self, path: Path, app_dir: Path, settings: str = ''):
+        self._path = path
+        self._app_dir = app_dir
+        self._settings = settings
+        self._lock = Lock()
+        self._hashes: Dict[Path, str] = {}
+        # Number of completed imports and the total number of imports of each path hash
+        self._progress: Dict[str, Tuple[int, int]] = {}
+
+        if path.exists():
+            complete_size = 0
+            with path.open('rb') as f:
+                for line in f:
+                    # An entry without a newline was being written when interrupted
+                    if not line.endswith(b'\n'):
+                        break
+                    complete_size += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._add_segments(entry['segments'])
+
+            # Remove the interrupted entry, so the next entry isn't appended to it
+            if complete_size < path.stat().st_size:
+                os.truncate(path, complete_size)
+
+    def _add_segments(self, segments: List[Dict[str, Any]]) -> None:
+        for segment in segments:
+            completed, _ = self._progress.get(segment['hash'], (0, segment['size']))
+            if segment['start'] <= completed:
+                self._progress[segment['hash']] = (max(completed, segment['end']), segment['size'])
+
+    def get_hash(self, path: Path) -> str:
+        with self._lock:
+            path_hash = self._hashes.get(path)
+        if path_hash is not None:
+            return path_hash
+
+        path_hash = hashlib.sha256(self._settings.encode('utf-8'))
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                path_hash.update(chunk)
+        path_hash = path_hash.hexdigest()
+
+        with self._lock:
+            self._hashes[path] = path_hash
+        return path_hash
+
+    def get_completed(self, path: Path) -> Union[Tuple[int, int], None]:
+        # Get the number of imports completed from the path and its total number of imports,
+        # or None if no imports from the path have been recorded
+        path_hash = self.get_hash(path)
+        with self._lock:
+            return self._progress.get(path_hash)
+
+    def record(self, segments: List[Tuple[Path, int, int, int]], result: Dict[str, Any]) -> None:
+        # Record the imported (path, start, end, size) segments of a batch
+        entry = {
+            'time': time.time(),
+            'segments': [{'path': str(path.relative_to(self._app_dir)), 'hash': self.get_hash(path),
+                          'start': start, 'end': end, 'size': size} for path, start, end, size in segments],
+            'result': result,
+        }
+
+        with self._lock:
+            self._add_segments(entry['segments'])
+
+            # Flush each entry to disk, as the import may be interrupted at any time
+            with self._path.open('a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,15 +1,37 @@
-from typing import List, Any
+from typing import List, Any, Dict, Tuple, Iterable, Iterator
 
 
-def get_unique_value(target_list: List[Any], unique_fields: List[str], value: Any) -> [Any, None]:
-    for exist_value in target_list:
-        if all(exist_value[f] == value[f] for f in unique_fields):
-            return exist_value
+# A list of values that are unique by the given fields, indexed by those fields so lookups don't scan the list.
+# The first value added with a given set of unique field values is kept.
+class UniqueList:
+    def __init__(self, unique_fields: List[str], values: Iterable[Any] = ()):
+        self._unique_fields = unique_fields
+        self._values: List[Any] = []
+        self._idxs: Dict[Tuple, int] = {}
+        for value in values:
+            self.add(value)
 
+    def _get_key(self, value: Any) -> Tuple:
+        return tuple(value[f] for f in self._unique_fields)
 
-def add_unique_to_list(target_list: List[Any], unique_fields: List[str], value: Any) -> int:
-    for idx, exist_value in enumerate(target_list):
-        if all(exist_value[f] == value[f] for f in unique_fields):
-            return idx
-    target_list.append(value)
-    return len(target_list) - 1
+    def get(self, value: Any) -> [Any, None]:
+        idx = self._idxs.get(self._get_key(value))
+        return None if idx is None else self._values[idx]
+
+    def add(self, value: Any) -> int:
+        key = self._get_key(value)
+        idx = self._idxs.get(key)
+        if idx is None:
+            idx = len(self._values)
+            self._values.append(value)
+            self._idxs[key] = idx
+        return idx
+
+    def __getitem__(self, idx: int) -> Any:
+        return self._values[idx]
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
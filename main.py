@@ -1,19 +1,24 @@
+import json
 import os
 import shutil
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import List, Type
+from typing import Iterable, Iterator, List, Tuple, Type, Deque
 
 from dotenv import load_dotenv
 from splashback_data.model.import_results import ImportResults
-from splashback_data.model.model_import import ModelImport
 
+import pipeline
 from finder import BaseFinder
 from finder.request import RequestFinder
 from finder.thredds import ThreddsFinder
-from parser import BaseParser
+from journal import ImportJournal
+from parser import BaseParser, ParsedImports
 from parser.json import JsonParser
 from parser.netcdf import NetcdfParser
 from splashback import SplashbackImporter
@@ -62,24 +67,251 @@ def main_interactive(app_dir: Path) -> None:
     m_parser = select_parser(path)
     imports = m_parser.start_interactive()
 
-    m_importer = SplashbackImporter(os.environ['SPLASHBACK_API_KEY'], args.pool_id)
-    check_results = m_importer.check(imports)
-    metadata = m_parser.start_metadata_interactive(check_results)
+    with create_importer(app_dir) as m_importer:
+        check_results = m_importer.check(imports)
+        metadata = m_parser.start_metadata_interactive(check_results)
+
+        line_len = shutil.get_terminal_size()[0]
+        for name, current, count in m_importer.create_metadata(metadata):
+            end = '\n' if current == count else '\r'
+            print(f'{name} ({current}/{count})'.ljust(line_len), end=end)
+        m_importer.run(imports, check_results=check_results)
+
+
+class Batch:
+    def __init__(self):
+        self.imports = ParsedImports()
+        self.parsers: List[BaseParser] = []
+        self.sizes: List[int] = []
+        self.paths: List[Path] = []
+        # Index of the first batched import in the imports of each parser, as large paths are split across batches
+        self.offsets: List[int] = []
+        self.path_sizes: List[int] = []
+
+    def add(self, path: Path, m_parser: BaseParser, path_imports: ParsedImports,
+            offset: int = 0, path_size: int = None) -> None:
+        self.imports.extend(path_imports)
+        self.parsers += [m_parser]
+        self.sizes += [len(path_imports)]
+        self.paths += [path]
+        self.offsets += [offset]
+        self.path_sizes += [len(path_imports) if path_size is None else path_size]
+
+    def get_path_names(self, app_dir: Path) -> List[str]:
+        path_names = []
+        for path, size, offset, path_size in zip(self.paths, self.sizes, self.offsets, self.path_sizes):
+            path_name = str(path.relative_to(app_dir))
+            if size != path_size:
+                path_name += f'[{offset}:{offset + size}]'
+            path_names.append(path_name)
+        return path_names
+
+
+def create_finder(app_dir: Path) -> BaseFinder:
+    if args.finder == 'thredds':
+        return ThreddsFinder(app_dir)
+    elif args.finder == 'request':
+        return RequestFinder(app_dir)
+    raise Exception(f'Unknown finder: {args.finder}')
+
+
+def get_parser_type() -> Type[BaseParser]:
+    if args.parser == 'netcdf':
+        return NetcdfParser
+    elif args.parser == 'json':
+        return JsonParser
+    raise Exception(f'Unknown parser: {args.parser}')
+
+
+def create_parser(path: Path) -> BaseParser:
+    return get_parser_type()(path)
+
+
+def create_importer(app_dir: Path) -> SplashbackImporter:
+    metadata_cache_path = None
+    if args.metadata_cache:
+        metadata_cache_path = app_dir.joinpath(f'.splashback_metadata_{args.pool_id}.json')
+
+    return SplashbackImporter(os.environ['SPLASHBACK_API_KEY'], args.pool_id,
+                              connection_pool_size=args.api_pool_size, compress=args.api_compress,
+                              metadata_workers=args.metadata_workers, metadata_cache_path=metadata_cache_path)
+
+
+def create_journal(app_dir: Path) -> ImportJournal:
+    # Imports depend on the parser, its mapping and options, so paths parsed differently are imported again
+    mapping_path = args.netcdf_mapping if args.parser == 'netcdf' else args.json_mapping
+    settings = [args.parser, Path(mapping_path).read_text(), sorted(args.option or [])]
+    return ImportJournal(app_dir.joinpath(f'.import_journal_{args.pool_id}.jsonl'), app_dir, json.dumps(settings))
+
+
+def print_connection_stats(m_importer: SplashbackImporter) -> None:
+    request_count, connection_count = m_importer.get_connection_stats()
+    print(f'Made {request_count} Splashback API requests over {connection_count} connections')
+
+
+def import_batch(m_importer: SplashbackImporter, m_finder: BaseFinder, batch: Batch, app_dir: Path,
+                 journal: ImportJournal) -> None:
+    if args.verbose:
+        print(f'Completed batch: {batch.imports}')
+
+    # Check batch
+    check_results = m_importer.check(batch.imports)
+
+    # Generate missing metadata
+    metadata = None
+    for idx, m_parser in enumerate(batch.parsers):
+        m_start_idx = sum(batch.sizes[0:idx])
+        m_end_idx = m_start_idx + batch.sizes[idx]
+        m_messages = [m for m in check_results['messages'] if m_start_idx <= m['index'] < m_end_idx]
+        for m in m_messages:
+            m['index'] += batch.offsets[idx] - m_start_idx
+        m_check_results = ImportResults._from_openapi_data(messages=m_messages)
+        metadata = m_parser.start_metadata_silent(m_check_results, args, metadata=metadata)
+
+        # Restore batch indices, so the check results can be reused for the import
+        for m in m_messages:
+            m['index'] -= batch.offsets[idx] - m_start_idx
+
+    if metadata is not None:
+        # Create metadata
+        line_len = shutil.get_terminal_size()[0]
+        for name, current, count in m_importer.create_metadata(metadata):
+            if args.verbose:
+                end = '\n' if current == count else '\r'
+                print(f'{name} ({current}/{count})'.ljust(line_len), end=end)
+
+    # Import batch
+    option_skip_exist_sample = 'skip_exist_sample' in args.option if type(args.option) is list else False
+    result = m_importer.run(batch.imports, dry_run=args.dry_run, skip_exist_sample=option_skip_exist_sample,
+                            check_results=check_results)
+
+    print(f'Imported {result["imported_sample_count"]} samples,'
+          f' {result["imported_variant_count"]} variants and'
+          f' {result["imported_value_count"]} values from'
+          f' {",".join(batch.get_path_names(app_dir))}')
+
+    # Record the imported segments, so they are skipped if the import is resumed
+    if not args.dry_run:
+        segments = [(path, offset, offset + size, path_size) for path, offset, size, path_size
+                    in zip(batch.paths, batch.offsets, batch.sizes, batch.path_sizes)]
+        journal.record(segments, {k: result[k] for k in
+                                  ['imported_sample_count', 'imported_variant_count', 'imported_value_count']})
+
+        # Let the finder know which paths have been imported completely
+        for path, _, end, path_size in segments:
+            if end >= path_size:
+                m_finder.complete_path(path)
+
+
+def find_unimported_paths(paths: Iterable[Path], m_finder: BaseFinder, app_dir: Path, journal: ImportJournal) \
+        -> Iterator[Tuple[Path, int]]:
+    for path in paths:
+        # Skip paths imported by an earlier run, and resume partially imported paths
+        offset = 0
+        if not args.ignore_journal:
+            progress = journal.get_completed(path)
+            if progress is not None:
+                offset, size = progress
+                if offset >= size:
+                    if args.verbose:
+                        print(f'Skipped imported path {path.relative_to(app_dir)}')
+                    if not args.dry_run:
+                        m_finder.complete_path(path)
+                    continue
+
+        yield path, offset
+
+
+def parse_paths_serially(paths: Iterable[Tuple[Path, int]]) \
+        -> Iterator[Tuple[Path, BaseParser, ParsedImports, int]]:
+    for path, offset in paths:
+        m_parser = create_parser(path)
+        yield path, m_parser, m_parser.start_silent(args), offset
+
+
+def parse_path_imports(parser_type: Type[BaseParser], path: Path, parse_args: Namespace) -> ParsedImports:
+    # Parse a path in a parse worker process
+    return parser_type(path).start_silent(parse_args)
+
+
+def parse_paths_concurrently(paths: Iterable[Tuple[Path, int]]) \
+        -> Iterator[Tuple[Path, BaseParser, ParsedImports, int]]:
+    def get_result() -> Tuple[Path, BaseParser, ParsedImports, int]:
+        path, offset, future = futures.popleft()
+        path_imports = future.result()
+
+        # Metadata is generated in this process, so give it a parser that has the parsed imports
+        m_parser = create_parser(path)
+        m_parser.restore_silent(args, path_imports)
+        return path, m_parser, path_imports, offset
+
+    # Yield paths in order, only parsing a few paths ahead of the caller
+    parse_window = args.parse_workers * 2
+    with ProcessPoolExecutor(max_workers=args.parse_workers) as executor:
+        futures: Deque[Tuple[Path, int, Future]] = deque()
+        for path, offset in paths:
+            futures.append((path, offset, executor.submit(parse_path_imports, get_parser_type(), path, args)))
+            if len(futures) >= parse_window:
+                yield get_result()
+        while len(futures) > 0:
+            yield get_result()
+
+
+def parse_paths(paths: Iterable[Path], m_finder: BaseFinder, app_dir: Path, journal: ImportJournal) \
+        -> Iterator[Tuple[Path, BaseParser, ParsedImports, int]]:
+    unimported_paths = find_unimported_paths(paths, m_finder, app_dir, journal)
+    if args.parse_workers > 1:
+        parsed_paths = parse_paths_concurrently(unimported_paths)
+    else:
+        parsed_paths = parse_paths_serially(unimported_paths)
+
+    for parse_count, (path, m_parser, path_imports, offset) in enumerate(parsed_paths, start=1):
+        if args.verbose:
+            print(f'Parsed {len(path_imports)} imports from {path.relative_to(app_dir)} ({parse_count} files parsed)')
+            if offset > 0:
+                print(f'Resuming {path.relative_to(app_dir)} from import {offset}')
+        yield path, m_parser, path_imports, offset
+
+
+def generate_batches(parsed_paths: Iterable[Tuple[Path, BaseParser, ParsedImports, int]]) -> Iterator[Batch]:
+    batch = Batch()
+    for path, m_parser, path_imports, offset in parsed_paths:
+        sample_ends = None
+        while True:
+            # If we have at least one import in the batch and have reached the batch size, start a new batch.
+            # The parsed path is carried forward to the new batch, so it is only parsed once
+            remaining_size = len(path_imports) - offset
+            if len(batch.imports) != 0 and len(batch.imports) + remaining_size > args.batch_size:
+                yield batch
+                batch = Batch()
+
+            # Append path imports, splitting paths with more imports than the batch size across batches
+            size = min(remaining_size, max(args.batch_size - len(batch.imports), 1))
+            if size < remaining_size:
+                # Only split between samples, as skip_exist_sample would skip the rest of a sample created by an
+                # earlier batch. Samples with more imports than the batch size are kept in one larger batch.
+                if sample_ends is None:
+                    sample_ends = BaseParser.get_sample_ends(path_imports)
+                end_idx = bisect_right(sample_ends, offset + size) - 1
+                if end_idx < 0 or sample_ends[end_idx] <= offset:
+                    end_idx = bisect_right(sample_ends, offset)
+                size = sample_ends[end_idx] - offset
+            batch.add(path, m_parser, path_imports[offset:offset + size], offset=offset, path_size=len(path_imports))
+
+            offset += size
+            if offset >= len(path_imports):
+                break
 
-    line_len = shutil.get_terminal_size()[0]
-    for name, current, count in m_importer.create_metadata(metadata):
-        end = '\n' if current == count else '\r'
-        print(f'{name} ({current}/{count})'.ljust(line_len), end=end)
-    m_importer.run(imports)
+    if len(batch.paths) > 0:
+        yield batch
 
 
 def main_silent(app_dir: Path) -> None:
-    if args.finder == 'thredds':
-        m_finder = ThreddsFinder(app_dir)
-    elif args.finder == 'request':
-        m_finder = RequestFinder(app_dir)
-    else:
-        raise Exception(f'Unknown finder: {args.finder}')
+    m_finder = create_finder(app_dir)
+
+    if args.pipeline:
+        main_pipeline(app_dir, m_finder)
+        return
 
     paths = m_finder.start_silent(args)
 
@@ -92,71 +324,45 @@ def main_silent(app_dir: Path) -> None:
         paths = [path for idx, path in enumerate(paths) if idx >= start_path_idxs[0]]
 
     # Create importer
-    m_importer = SplashbackImporter(os.environ['SPLASHBACK_API_KEY'], args.pool_id)
-
-    # Process all paths
-    while len(paths) > 0:
-        # Generate batch
-        batch_imports: List[ModelImport] = []
-        batch_parsers: List[BaseParser] = []
-        batch_sizes: List[int] = []
-        batch_paths: List[Path] = []
-        for path in paths:
-            if args.parser == 'netcdf':
-                m_parser = NetcdfParser(path)
-            elif args.parser == 'json':
-                m_parser = JsonParser(path)
-            else:
-                raise Exception(f'Unknown parser: {args.parser}')
-
-            path_imports = m_parser.start_silent(args)
+    journal = create_journal(app_dir)
+    with create_importer(app_dir) as m_importer:
+        # Process all paths
+        for batch in generate_batches(parse_paths(paths, m_finder, app_dir, journal)):
+            import_batch(m_importer, m_finder, batch, app_dir, journal)
 
-            # If we have at least one import in the batch and have reached the batch size, break
-            if len(batch_imports) != 0 and len(batch_imports) + len(path_imports) > args.batch_size:
-                break
+        if args.verbose:
+            print_connection_stats(m_importer)
+
+
+def main_pipeline(app_dir: Path, m_finder: BaseFinder) -> None:
+    # Find paths, parse them into batches and import the batches in separate stages,
+    # with bounded queues between them so no stage gets too far ahead of the next
+    def find_paths() -> Iterator[Path]:
+        start_path = Path(args.start_path) if args.start_path is not None else None
+        for path in m_finder.iter_silent(args):
+            # Start from start path if provided
+            if start_path is not None:
+                if path.relative_to(app_dir) != start_path:
+                    continue
+                start_path = None
+            yield path
+
+        if start_path is not None:
+            raise Exception(f'Failed to find first path: {start_path}')
 
-            # Append path imports
-            batch_imports += path_imports
-            batch_parsers += [m_parser]
-            batch_sizes += [len(path_imports)]
-            batch_paths += [path]
+    journal = create_journal(app_dir)
+    paths = pipeline.threaded(find_paths(), args.pipeline_queue_size)
+    parsed_paths = parse_paths(paths, m_finder, app_dir, journal)
+    batches = pipeline.threaded(generate_batches(parsed_paths), args.pipeline_queue_size)
 
-        # Remove batched paths
-        paths = paths[len(batch_paths):]
+    # Create importer
+    with create_importer(app_dir) as m_importer:
+        # Process all batches
+        for batch in batches:
+            import_batch(m_importer, m_finder, batch, app_dir, journal)
 
         if args.verbose:
-            print(f'Completed batch: {batch_imports}')
-
-        # Check batch
-        check_results = m_importer.check(batch_imports)
-
-        # Generate missing metadata
-        metadata = None
-        for idx, m_parser in enumerate(batch_parsers):
-            m_start_idx = sum(batch_sizes[0:idx])
-            m_end_idx = m_start_idx + batch_sizes[idx]
-            m_messages = [m for m in check_results['messages'] if m_start_idx <= m['index'] < m_end_idx]
-            for m in m_messages:
-                m['index'] -= m_start_idx
-            m_check_results = ImportResults._from_openapi_data(messages=m_messages)
-            metadata = m_parser.start_metadata_silent(m_check_results, args, metadata=metadata)
-
-        if metadata is not None:
-            # Create metadata
-            line_len = shutil.get_terminal_size()[0]
-            for name, current, count in m_importer.create_metadata(metadata):
-                if args.verbose:
-                    end = '\n' if current == count else '\r'
-                    print(f'{name} ({current}/{count})'.ljust(line_len), end=end)
-
-        # Import batch
-        option_skip_exist_sample = 'skip_exist_sample' in args.option if type(args.option) is list else False
-        result = m_importer.run(batch_imports, dry_run=args.dry_run, skip_exist_sample=option_skip_exist_sample)
-
-        print(f'Imported {result["imported_sample_count"]} samples,'
-              f' {result["imported_variant_count"]} variants and'
-              f' {result["imported_value_count"]} values from'
-              f' {",".join([str(path.relative_to(app_dir)) for path in batch_paths])}')
+            print_connection_stats(m_importer)
 
 
 if __name__ == '__main__':
@@ -173,10 +379,42 @@ if __name__ == '__main__':
                         help='Number of imports per batch.')
     parser.add_argument('--dry-run', action='store_true',
                         help='Do not publish the data to Splashback.')
+    parser.add_argument('--api-pool-size', type=int,
+                        help='Maximum number of connections kept open to the Splashback API.')
+    parser.add_argument('--api-compress', action='store_true',
+                        help='Gzip Splashback API request bodies. The API must accept gzip encoded requests.')
+    parser.add_argument('--metadata-workers', type=int, default=1,
+                        help='Number of metadata entities and lookups to create concurrently.')
+    parser.add_argument('--metadata-cache', action='store_true',
+                        help='Keep the remote Splashback metadata in the data directory between runs, rather than '
+                             'fetching it again. Only use if no other user removes metadata from the pool.')
     parser.add_argument('-d', '--dir', type=str,
                         help='Directory to store data. If unspecified a temporary directory will be used.')
+    parser.add_argument('--download-workers', type=int, default=1,
+                        help='Number of files to download concurrently.')
+    parser.add_argument('--download-host-workers', type=int,
+                        help='Maximum number of concurrent downloads from a single host. Unlimited if unspecified.')
+    parser.add_argument('--download-chunk-size', type=int, default=1024,
+                        help='Size in KiB of the chunks downloads are written in.')
+    parser.add_argument('--download-refresh', action='store_true',
+                        help='Check existing downloads with the server, downloading them again if they have changed.')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to cache downloads in, shared by every run and pool. Disabled if unspecified.')
+    parser.add_argument('--cache-size', type=int,
+                        help='Maximum size of the download cache in MiB, removing the least recently used downloads '
+                             'once exceeded. Unlimited if unspecified.')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help='Number of processes to parse files in.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Download, parse and import concurrently, rather than one after the other.')
+    parser.add_argument('--pipeline-queue-size', type=int, default=2,
+                        help='Number of paths and batches each pipeline stage may prepare ahead of the next.')
     parser.add_argument('--start-path', type=str,
-                        help='Path to start importing from. Useful if an import was interrupted and should be resumed.')
+                        help='Path to start importing from. Interrupted imports are resumed automatically when '
+                             'using the same data directory, unless --ignore-journal is given.')
+    parser.add_argument('--ignore-journal', action='store_true',
+                        help='Import all paths, including those already imported into the pool from the data '
+                             'directory.')
     # Add valid finder choices here
     parser.add_argument('-f', '--finder', type=str, choices=['thredds', 'request'],
                         help='Finder to locate and fetch data.')
@@ -200,6 +438,13 @@ if __name__ == '__main__':
                               help='Enable pattern matching for THREDDS Dataset ID.')
     parser_group.add_argument('--thredds-service', type=str, required=is_finder_thredds,
                               help='THREDDS Service name to use for dataset download.')
+    parser_group.add_argument('--thredds-crawl-workers', type=int, default=1,
+                              help='Number of THREDDS catalogs to load concurrently when pattern matching.')
+    parser_group.add_argument('--thredds-cache-ttl', type=float, default=0.,
+                              help='Seconds to use cached THREDDS catalogs before revalidating them with the server.')
+    parser_group.add_argument('--thredds-incremental', action='store_true',
+                              help='Only download and import datasets that are new or have changed date or size since '
+                                   'they were last imported into the pool. Requires --thredds-dataset-pattern.')
     is_finder_request = not current_args.interactive and current_args.finder == 'request'
     parser_group = parser.add_argument_group(title='Finder: request',
                                              description='Make a web API request.')
@@ -212,11 +457,15 @@ if __name__ == '__main__':
                                              description='Read NetCDF files.')
     parser_group.add_argument('--netcdf-mapping', type=str, required=is_parser_netcdf,
                               help='Field mapping file for the NetCDF parser.')
+    parser_group.add_argument('--netcdf-cache-size', type=int,
+                              help='Maximum MiB of variable data cached per NetCDF file. Unlimited if unspecified.')
     is_parser_json = not current_args.interactive and current_args.parser == 'json'
     parser_group = parser.add_argument_group(title='Parser: json',
                                              description='Read JSON files.')
     parser_group.add_argument('--json-mapping', type=str, required=is_parser_json,
                               help='Field mapping file for the JSON parser.')
+    parser_group.add_argument('--json-stream', action='store_true',
+                              help='Read the rows of JSON files one at a time, rather than loading the whole file.')
 
     args = parser.parse_args()
 
@@ -1,6 +1,7 @@
 from argparse import Namespace
+from array import array
 from pathlib import Path
-from typing import List, Set, Dict, Tuple
+from typing import List, Set, Dict, Tuple, Any, Iterator, Iterable, Union
 
 from splashback_data.model.import_results import ImportResults
 from splashback_data.model.laboratory_object import LaboratoryObject
@@ -12,18 +13,18 @@ from splashback_data.model.sample_variant_type_object import SampleVariantTypeOb
 from splashback_data.model.sampling_method_object import SamplingMethodObject
 from splashback_data.model.site_object import SiteObject
 
-import listutils
+from listutils import UniqueList
 
 
 class ParsedMetadata:
     def __init__(self):
-        self.__sites: List[SiteObject] = []
-        self.__programs: List[ProgramObject] = []
-        self.__variant_types: List[SampleVariantTypeObject] = []
-        self.__parameters: List[ParameterObject] = []
-        self.__laboratories: List[LaboratoryObject] = []
-        self.__sampling_methods: List[SamplingMethodObject] = []
-        self.__qualities: List[QualityObject] = []
+        self.__sites = UniqueList(['name', 'location'])
+        self.__programs = UniqueList(['name'])
+        self.__variant_types = UniqueList(['name'])
+        self.__parameters = UniqueList(['name', 'unit'])
+        self.__laboratories = UniqueList(['name'])
+        self.__sampling_methods = UniqueList(['name'])
+        self.__qualities = UniqueList(['name'])
         self.__lookups: Dict[str, Set[str]] = {
             'sites': set(),
             'programs': set(),
@@ -34,64 +35,64 @@ class ParsedMetadata:
         }
 
     def add_site(self, obj: SiteObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__sites, ['name', 'location'], obj)
+        obj_idx = self.__sites.add(obj)
         if lookup_key is not None:
             self.add_lookup('sites', lookup_key, obj_idx)
 
     @property
-    def sites(self) -> List[SiteObject]:
+    def sites(self) -> UniqueList:
         return self.__sites
 
     def add_program(self, obj: ProgramObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__programs, ['name'], obj)
+        obj_idx = self.__programs.add(obj)
         if lookup_key is not None:
             self.add_lookup('programs', lookup_key, obj_idx)
 
     @property
-    def programs(self) -> List[ProgramObject]:
+    def programs(self) -> UniqueList:
         return self.__programs
 
     def add_variant_type(self, obj: SampleVariantTypeObject):
-        listutils.add_unique_to_list(self.__variant_types, ['name'], obj)
+        self.__variant_types.add(obj)
 
     @property
-    def variant_types(self) -> List[SampleVariantTypeObject]:
+    def variant_types(self) -> UniqueList:
         return self.__variant_types
 
     def add_parameter(self, obj: ParameterObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__parameters, ['name', 'unit'], obj)
+        obj_idx = self.__parameters.add(obj)
         if lookup_key is not None:
             self.add_lookup('parameters', lookup_key, obj_idx)
 
     @property
-    def parameters(self) -> List[ParameterObject]:
+    def parameters(self) -> UniqueList:
         return self.__parameters
 
     def add_laboratory(self, obj: LaboratoryObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__laboratories, ['name'], obj)
+        obj_idx = self.__laboratories.add(obj)
         if lookup_key is not None:
             self.add_lookup('laboratories', lookup_key, obj_idx)
 
     @property
-    def laboratories(self) -> List[LaboratoryObject]:
+    def laboratories(self) -> UniqueList:
         return self.__laboratories
 
     def add_sampling_method(self, obj: SamplingMethodObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__sampling_methods, ['name'], obj)
+        obj_idx = self.__sampling_methods.add(obj)
         if lookup_key is not None:
             self.add_lookup('sampling_methods', lookup_key, obj_idx)
 
     @property
-    def sampling_methods(self) -> List[SamplingMethodObject]:
+    def sampling_methods(self) -> UniqueList:
         return self.__sampling_methods
 
     def add_quality(self, obj: QualityObject, lookup_key: str = None):
-        obj_idx = listutils.add_unique_to_list(self.__qualities, ['name'], obj)
+        obj_idx = self.__qualities.add(obj)
         if lookup_key is not None:
             self.add_lookup('qualities', lookup_key, obj_idx)
 
     @property
-    def qualities(self) -> List[QualityObject]:
+    def qualities(self) -> UniqueList:
         return self.__qualities
 
     def add_lookup(self, obj_type: str, key: str, idx: int):
@@ -105,18 +106,133 @@ class ParsedMetadata:
         return list(map(map_lookup, self.__lookups[obj_type]))
 
 
+# Parsed imports stored by field rather than by import, as most fields repeat the same few values across imports.
+# Each field keeps a list of its distinct values, and each import only stores the index of its value in that list.
+# Imports are read as dicts of their field values, and are only turned into models when needed.
+class ParsedImports:
+    def __init__(self, fields: List[str] = None):
+        self._fields: List[str] = []
+        self._values: Dict[str, List[Any]] = {}
+        self._value_codes: Dict[str, Dict[Tuple[type, Any], int]] = {}
+        self._codes: Dict[str, array] = {}
+        self._size = 0
+        if fields is not None:
+            self._add_fields(fields)
+
+    def _add_fields(self, fields: Iterable[str]) -> None:
+        for field in fields:
+            self._fields.append(field)
+            self._values[field] = []
+            self._value_codes[field] = {}
+            self._codes[field] = array('I')
+
+    def _get_code(self, field: str, value: Any) -> int:
+        # Values are keyed with their type, as e.g. 1, 1.0 and True are equal but aren't serialized the same
+        value_codes = self._value_codes[field]
+        key = (type(value), value)
+        try:
+            code = value_codes.get(key)
+        except TypeError:
+            raise Exception(f'Unhashable value for import field {field}: {value!r}')
+        if code is None:
+            code = len(self._values[field])
+            self._values[field].append(value)
+            value_codes[key] = code
+        return code
+
+    @property
+    def fields(self) -> List[str]:
+        return self._fields
+
+    def append(self, mdl: Dict[str, Any]) -> None:
+        if len(self._fields) == 0:
+            self._add_fields(mdl.keys())
+
+        for field in self._fields:
+            self._codes[field].append(self._get_code(field, mdl[field]))
+        self._size += 1
+
+    def extend(self, other: 'ParsedImports') -> None:
+        if len(other) == 0:
+            return
+        if len(self._fields) == 0:
+            self._add_fields(other.fields)
+
+        # Map the value indices of the other imports to the value indices of these imports,
+        # only adding the values the other imports use
+        for field in self._fields:
+            other_values = other._values[field]
+            mapped_codes: Dict[int, int] = {}
+            codes = self._codes[field]
+            for other_code in other._codes[field]:
+                code = mapped_codes.get(other_code)
+                if code is None:
+                    code = self._get_code(field, other_values[other_code])
+                    mapped_codes[other_code] = code
+                codes.append(code)
+        self._size += len(other)
+
+    def _share_values(self) -> 'ParsedImports':
+        # Values are only ever appended, so imports selected from these imports can share them
+        shared = ParsedImports()
+        shared._fields = list(self._fields)
+        shared._values = dict(self._values)
+        shared._value_codes = dict(self._value_codes)
+        return shared
+
+    def select(self, idxs: List[int]) -> 'ParsedImports':
+        selected = self._share_values()
+        for field in self._fields:
+            codes = self._codes[field]
+            selected._codes[field] = array('I', (codes[idx] for idx in idxs))
+        selected._size = len(idxs)
+        return selected
+
+    def get_column(self, field: str) -> List[Any]:
+        return list(map(self._values[field].__getitem__, self._codes[field]))
+
+    def iter_values(self) -> Iterator[Tuple]:
+        # Yield the field values of each import, in the order of fields
+        return zip(*(map(self._values[f].__getitem__, self._codes[f]) for f in self._fields))
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict[str, Any], 'ParsedImports']:
+        if isinstance(idx, slice):
+            sliced = self._share_values()
+            for field in self._fields:
+                sliced._codes[field] = self._codes[field][idx]
+            sliced._size = len(range(self._size)[idx])
+            return sliced
+
+        return {f: self._values[f][self._codes[f][idx]] for f in self._fields}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for values in self.iter_values():
+            yield dict(zip(self._fields, values))
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+# Fields of the sample an import belongs to. The imports of each sample are kept together, so paths split across
+# batches are only split between samples, and skip_exist_sample doesn't skip samples created by an earlier batch.
+sample_fields = ['site_code', 'date', 'program']
+
+
 class BaseParser:
     def __init__(self, path: Path):
         self._path: Path = path
-        self._imports: List[ModelImport] = []
+        self._imports = ParsedImports()
 
-    def start_interactive(self) -> List[ModelImport]:
+    def start_interactive(self) -> ParsedImports:
         return self._start_interactive()
 
-    def _start_interactive(self) -> List[ModelImport]:
+    def _start_interactive(self) -> ParsedImports:
         raise NotImplementedError()
 
-    def start_silent(self, args: Namespace) -> List[ModelImport]:
+    def start_silent(self, args: Namespace) -> ParsedImports:
         ignore_zero_dups = 'ignore_zero_dups' in args.option if type(args.option) is list else False
         ignore_dups = 'ignore_dups' in args.option if type(args.option) is list else False
 
@@ -125,9 +241,15 @@ class BaseParser:
             self._ignore_zero_dups()
         if ignore_dups:
             self._ignore_dups()
+        self._group_samples()
         return self._imports
 
-    def _start_silent(self, args: Namespace) -> List[ModelImport]:
+    def _start_silent(self, args: Namespace) -> ParsedImports:
+        raise NotImplementedError()
+
+    def restore_silent(self, args: Namespace, imports: ParsedImports) -> None:
+        # Prepare for start_metadata_silent with imports parsed by another parser of the same path,
+        # e.g. in another process, without parsing the path again
         raise NotImplementedError()
 
     def start_metadata_interactive(self, results: ImportResults, metadata: ParsedMetadata = None) -> ParsedMetadata:
@@ -148,36 +270,60 @@ class BaseParser:
                and a['variant_comment'] == b['variant_comment'] \
                and a['parameter'] == b['parameter']
 
-    def _ignore_zero_dups(self) -> None:
-        def is_zero_model(mdl: ModelImport):
-            return float(mdl['value']) == 0. and float(mdl['variant_value']) == 0.
-
-        zero_dup_idxs = set()
-        for idx_a, mdl_a in enumerate(self._imports):
-            for idx_b, mdl_b in enumerate(self._imports):
-                # Only check previous entries
-                if idx_b >= idx_a:
-                    break
+    def _get_model_keys(self) -> List[Tuple]:
+        # Models with equal keys are equal according to _compare_models
+        return list(zip(*(self._imports.get_column(f) for f in ['site_code', 'date', 'program', 'variant_type',
+                                                                 'variant_date_time', 'variant_value',
+                                                                 'variant_comment', 'parameter'])))
+
+    def _group_samples(self) -> None:
+        if len(self._imports) == 0:
+            return
+
+        # Order samples by their first import, keeping the order of the imports of each sample
+        sample_idxs: Dict[Tuple, List[int]] = {}
+        for idx, key in enumerate(zip(*(self._imports.get_column(f) for f in sample_fields))):
+            idxs = sample_idxs.get(key)
+            if idxs is None:
+                sample_idxs[key] = [idx]
+            else:
+                idxs.append(idx)
+        self._imports = self._imports.select([idx for idxs in sample_idxs.values() for idx in idxs])
 
-                # Compare
-                if self._compare_models(mdl_a, mdl_b):
-                    if is_zero_model(mdl_a):
-                        zero_dup_idxs.add(idx_a)
-                    if is_zero_model(mdl_b):
-                        zero_dup_idxs.add(idx_b)
+    @staticmethod
+    def get_sample_ends(imports: ParsedImports) -> List[int]:
+        # Get the index after the last import of each sample, of imports grouped by sample
+        if len(imports) == 0:
+            return []
+        keys = list(zip(*(imports.get_column(f) for f in sample_fields)))
+        return [idx for idx in range(1, len(keys)) if keys[idx] != keys[idx - 1]] + [len(keys)]
 
-        self._imports = [mdl for idx, mdl in enumerate(self._imports) if idx not in zero_dup_idxs]
+    def _ignore_zero_dups(self) -> None:
+        if len(self._imports) == 0:
+            return
+
+        # Count the models with each key
+        key_counts: Dict[Tuple, int] = {}
+        model_keys = self._get_model_keys()
+        for key in model_keys:
+            key_counts[key] = key_counts.get(key, 0) + 1
+
+        # Remove zero models that have a duplicate
+        values = self._imports.get_column('value')
+        variant_values = self._imports.get_column('variant_value')
+        self._imports = self._imports.select(
+            [idx for idx, (key, value, variant_value) in enumerate(zip(model_keys, values, variant_values))
+             if key_counts[key] == 1 or not (float(value) == 0. and float(variant_value) == 0.)])
 
     def _ignore_dups(self) -> None:
-        dup_idxs = set()
-        for idx_a, mdl_a in enumerate(self._imports):
-            for idx_b, mdl_b in enumerate(self._imports):
-                # Only check previous entries
-                if idx_b >= idx_a:
-                    break
-
-                # Compare
-                if self._compare_models(mdl_a, mdl_b):
-                    dup_idxs.add(idx_b)
-
-        self._imports = [mdl for idx, mdl in enumerate(self._imports) if idx not in dup_idxs]
\ No newline at end of file
+        if len(self._imports) == 0:
+            return
+
+        # Find the index of the last model with each key
+        last_idxs: Dict[Tuple, int] = {}
+        model_keys = self._get_model_keys()
+        for idx, key in enumerate(model_keys):
+            last_idxs[key] = idx
+
+        # Keep only the last of each duplicate
+        self._imports = self._imports.select([idx for idx, key in enumerate(model_keys) if last_idxs[key] == idx])
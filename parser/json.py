@@ -1,14 +1,14 @@
 import json
 import re
 from argparse import Namespace
+from functools import partial
 from pathlib import Path
-from typing import List, Generator, Any, Type
+from typing import List, Generator, Any, Type, Dict, Tuple, TextIO, Callable, Union
 
 from splashback_data.model.import_check_stage import ImportCheckStage
 from splashback_data.model.import_check_status import ImportCheckStatus
 from splashback_data.model.import_results import ImportResults
 from splashback_data.model.laboratory_object import LaboratoryObject
-from splashback_data.model.model_import import ModelImport
 from splashback_data.model.parameter_object import ParameterObject
 from splashback_data.model.program_object import ProgramObject
 from splashback_data.model.quality_object import QualityObject
@@ -16,33 +16,61 @@ from splashback_data.model.sample_variant_type_object import SampleVariantTypeOb
 from splashback_data.model.sampling_method_object import SamplingMethodObject
 from splashback_data.model.site_object import SiteObject
 
-import timeconverters
-from parser import BaseParser, ParsedMetadata
+from parser import BaseParser, ParsedImports, ParsedMetadata
+from parser.template import CompiledTemplate, FieldContext, FieldEvaluator, TemplateCompiler
 
 
 class JsonParser(BaseParser):
     def __init__(self, path: Path):
         super().__init__(path)
 
-        with open(path, 'r') as j:
-            self._json = json.load(j)
+        # The JSON file is only read once needed, as restored parsers may never need it
+        self._json: Any = None
         self._mapping = {}
+        self._templates: Dict[str, CompiledTemplate] = {}
+        self._metadata: Dict[Tuple[str, Tuple], Any] = {}
+        self._stream = False
+        self._json_stream: Union[JsonStream, None] = None
 
-    def _start_interactive(self) -> List[ModelImport]:
+    def _start_interactive(self) -> ParsedImports:
         raise NotImplementedError()
 
-    def _start_silent(self, args: Namespace) -> List[ModelImport]:
-        # Read mapping file
-        with open(args.json_mapping, 'r') as m:
-            self._mapping = json.load(m)
+    def _start_silent(self, args: Namespace) -> ParsedImports:
+        self._load_mapping(args)
 
         if args.verbose:
-            print('JSON', self._json)
+            if not self._stream:
+                print('JSON', self._get_json())
             print('Mapping', repr(self._mapping))
 
-        self._imports = [r for r in self._parse_imports()]
+        # Create the fields up front, so a path without imports still has them
+        self._imports = ParsedImports(list(self._mapping['templates']['import'].keys()))
+        for mdl in self._parse_imports():
+            self._imports.append(mdl)
         return self._imports
 
+    def restore_silent(self, args: Namespace, imports: ParsedImports) -> None:
+        self._load_mapping(args)
+        self._imports = imports
+
+    def _load_mapping(self, args: Namespace) -> None:
+        # Read mapping file
+        with open(args.json_mapping, 'r') as m:
+            self._mapping = json.load(m)
+        self._templates = template_compiler.compile_templates(self._mapping['templates'])
+        self._stream = args.json_stream
+
+    def _get_json(self) -> Any:
+        if self._json is None:
+            if self._stream:
+                # Read the JSON without its rows, which are not kept when streaming
+                for _ in self._iter_rows():
+                    pass
+            else:
+                with open(self._path, 'r') as j:
+                    self._json = json.load(j)
+        return self._json
+
     def start_metadata_interactive(self, results: ImportResults, metadata: ParsedMetadata = None) -> ParsedMetadata:
         raise NotImplementedError()
 
@@ -50,6 +78,8 @@ class JsonParser(BaseParser):
                               metadata: ParsedMetadata = None) -> ParsedMetadata:
         if metadata is None:
             metadata = ParsedMetadata()
+        # Metadata objects are given their remote ids once created, so only share them within one call
+        self._metadata = {}
 
         for message in results['messages']:
             # Filter status
@@ -98,115 +128,228 @@ class JsonParser(BaseParser):
             obj = obj[m_key]
         return obj
 
-    def _parse_imports(self) -> Generator[ModelImport, None, None]:
-        row_list = self._json
+    def _find_json(self, keys: List[str]) -> Any:
+        # While streaming, find values in the JSON read so far.
+        # The file is only read again for values after the rows, or values that contain them.
+        if self._json is None and self._json_stream is not None:
+            try:
+                value = self._find_by_path(self._json_stream.document, keys)
+            except (KeyError, IndexError, TypeError, ValueError):
+                pass
+            else:
+                if self._json_stream.is_complete(value):
+                    return value
+        return self._find_by_path(self._get_json(), keys)
+
+    def _iter_rows(self) -> Generator[Any, None, None]:
         import_path = self._mapping['import_path']
         import_path_keys = import_path.split('.')
-        row_list = self._find_by_path(row_list, import_path_keys)
+
+        if self._stream:
+            # Read rows one at a time, keeping the rest of the JSON once it has been read
+            with open(self._path, 'r') as j:
+                self._json_stream = JsonStream(j)
+                try:
+                    self._json = yield from self._json_stream.iter_rows(import_path_keys)
+                finally:
+                    self._json_stream = None
+            return
+
+        row_list = self._find_by_path(self._get_json(), import_path_keys)
         if not isinstance(row_list, list):
             raise Exception(f'Invalid type parsed for import path: {import_path}')
+        yield from row_list
 
+    def _parse_imports(self) -> Generator[Dict[str, Any], None, None]:
         # Iterate rows in import_path
-        for row_index in range(len(row_list)):
-            yield self._get_import(row_index)
-
-    def _get_import(self, row_index: int) -> ModelImport:
-        return ModelImport(**{k: self._get_field(v, row_index=row_index)
-                              for k, v in self._mapping['templates']['import'].items()})
+        for row_index, row in enumerate(self._iter_rows()):
+            yield self._get_import(row_index, row)
 
-    def _get_metadata(self, type: Type, template_name: str, model_import: ModelImport) -> Any:
-        return type(**{k: self._get_field(v, model_import=model_import)
-                       for k, v in self._mapping['templates'][template_name].items()})
+    def _get_import(self, row_index: int, row: Any) -> Dict[str, Any]:
+        return self._templates['import']({'parser': self, 'row_index': row_index, 'row': row})
 
-    def _get_field(self, field: str, row_index: int = None, model_import: ModelImport = None) -> Any:
-        field_parts = field.split('|')
-
-        exception = None
-        for field_part in field_parts:
-            try:
-                return self._get_field_value(field_part, row_index=row_index, model_import=model_import)
-            except Exception as e:
-                exception = e
+    def _get_metadata(self, type: Type, template_name: str, model_import: Dict[str, Any]) -> Any:
+        # Only evaluate each distinct metadata template once, as many messages reference the same metadata
+        template = self._templates[template_name]
+        model_key = template.get_model_key(model_import)
+        if model_key is None:
+            return type(**template({'parser': self, 'model_import': model_import}))
 
-        raise Exception(f'Failed to get field: {exception}')
-
-    def _get_field_value(self, field: str, row_index: int = None, model_import: ModelImport = None) -> Any:
-        # Strip field
-        field = field.strip()
-        if field == '':
-            return ''
-
-        # Get subfields
-        field = re.sub(r'\((.*)\)', lambda match: self._get_field(match.group(1), model_import=model_import), field)
-
-        # Parse args
-        accessor, *args_list = field.split(' ')
-        field_type = 'str'
-        if args_list[-1][0] == '!':
-            field_type = args_list.pop(-1)[1:]
-        args = ' '.join(args_list)
-
-        # JSON <path_name>: Get a JSON value
-        if accessor == 'JSON':
-            if len(args_list) != 1:
-                raise Exception('Expected one argument for accessor JSON')
-
-            field_value = self._json
-            keys = args_list[0].split('.')
-
-            # If leading key is $, reference current row
-            if keys[0] == '$':
-                if row_index is None:
-                    raise Exception('Cannot reference current row from this field.')
+        key = (template_name, model_key)
+        metadata = self._metadata.get(key)
+        if metadata is None:
+            metadata = type(**template({'parser': self, 'model_import': model_import}))
+            self._metadata[key] = metadata
+        return metadata
 
-                keys.pop(0)
-                import_path_keys = self._mapping['import_path'].split('.')
-                field_value = self._find_by_path(field_value, import_path_keys)
-                field_value = field_value[row_index]
 
-            field_value = self._find_by_path(field_value, keys)
+# Reads the rows of a JSON array one at a time, so a large file is never loaded at once.
+# Values outside the array are kept, as they are small compared to the rows and may be referenced by templates.
+class JsonStream:
+    chunk_size = 1024 * 1024
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, file: TextIO):
+        self._file = file
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._document: Any = None
+        self._containers: List[Any] = []
+
+    def _read(self) -> None:
+        # Read at least as much as is buffered, so a value spanning many chunks is not decoded many times
+        chunk = self._file.read(max(self.chunk_size, len(self._buffer) - self._pos))
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        self._eof = len(chunk) == 0
+
+    def _peek(self) -> str:
+        # Get the next character that isn't whitespace, without consuming it
+        while True:
+            self._pos = self.whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise Exception('Unexpected end of JSON')
+            self._read()
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if char not in chars:
+            raise Exception(f'Expected one of {chars} in JSON, found {char}')
+        self._pos += 1
+        return char
+
+    def _decode(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._read()
+                continue
 
-        # CONST <values...>: Constant value
-        elif accessor == 'CONST':
-            field_value = args
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._read()
+                continue
 
+            self._pos = end
+            return value
+
+    @property
+    def document(self) -> Any:
+        # The JSON read so far, with the array at the keys left empty
+        return self._document
+
+    def is_complete(self, value: Any) -> bool:
+        # Whether a value of the document has been read completely
+        return not any(value is container for container in self._containers)
+
+    def iter_rows(self, keys: List[str]) -> Generator[Any, None, Any]:
+        # Yield the rows of the array at the keys, then return the JSON with that array left empty
+        yield from self._iter_value(keys, self._set_document)
+        while True:
+            self._pos = self.whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                raise Exception('Unexpected data after JSON')
+            if self._eof:
+                return self._document
+            self._read()
+
+    def _set_document(self, document: Any) -> None:
+        self._document = document
+
+    def _iter_value(self, keys: List[str], attach: Callable[[Any], None]) -> Generator[Any, None, None]:
+        # Containers are attached to their parent as soon as they are started, so the document can be read while
+        # their rows are streamed, and kept as containers being read until they are complete
+        if len(keys) == 0:
+            if self._peek() != '[':
+                raise Exception('Invalid type parsed for import path')
+            attach([])
+            self._pos += 1
+            if self._peek() != ']':
+                while True:
+                    yield self._decode()
+                    if self._expect(',]') == ']':
+                        break
+            else:
+                self._pos += 1
+            return
+
+        char = self._peek()
+        found = False
+        if char == '{':
+            value = {}
+            attach(value)
+            self._containers.append(value)
+            self._pos += 1
+            if self._peek() != '}':
+                while True:
+                    key = self._decode()
+                    self._expect(':')
+                    if key == keys[0] and not found:
+                        yield from self._iter_value(keys[1:], partial(value.__setitem__, key))
+                        found = True
+                    else:
+                        value[key] = self._decode()
+                    if self._expect(',}') == '}':
+                        break
+            else:
+                self._pos += 1
+        elif char == '[':
+            value = []
+            attach(value)
+            self._containers.append(value)
+            index = int(keys[0])
+            self._pos += 1
+            if self._peek() != ']':
+                while True:
+                    if len(value) == index:
+                        yield from self._iter_value(keys[1:], value.append)
+                        found = True
+                    else:
+                        value.append(self._decode())
+                    if self._expect(',]') == ']':
+                        break
+            else:
+                self._pos += 1
         else:
-            raise Exception('Unknown accessor: %s' % accessor)
+            raise Exception(f'Invalid type parsed for key: {keys[0]}')
 
-        if field_value is None:
-            raise Exception('Field value not set')
+        if not found:
+            raise Exception(f'Failed to find key: {keys[0]}')
+        self._containers.pop()
 
-        # Convert to correct type and return
-        field_type_parts = field_type.split(':')
 
-        if field_type_parts[0] == 'str':
-            if isinstance(field_value, float):
-                field_str_value = f'{field_value:.30f}'
-            else:
-                field_str_value = str(field_value)
+# JSON <path_name>: Get a JSON value
+def _accessor_json(args_list: List[str], args: str) -> FieldEvaluator:
+    if len(args_list) != 1:
+        raise Exception('Expected one argument for accessor JSON')
+    keys = args_list[0].split('.')
 
-            if len(field_type_parts) == 1:
-                return field_str_value
-            return field_str_value[0:int(field_type_parts[1])]
+    # If leading key is $, reference current row
+    if keys[0] == '$':
+        row_keys = keys[1:]
 
-        elif field_type_parts[0] == 'float':
-            return float(field_value)
+        def evaluate(ctx: FieldContext) -> Any:
+            if ctx.get('row_index') is None:
+                raise Exception('Cannot reference current row from this field.')
 
-        elif field_type_parts[0] == 'datetime':
-            dt = None
-            if field_type_parts[1] == 'days_since_1950':
-                dt = timeconverters.convert_days_since_1950_to_datetime(float(field_value))
-            elif field_type_parts[1] == 'bom_date_time_full':
-                dt = timeconverters.convert_bom_date_time_full_to_datetime(field_value)
+            parser: JsonParser = ctx['parser']
+            return parser._find_by_path(ctx['row'], row_keys)
 
-            if dt is None:
-                raise Exception('Invalid datetime value type parser')
+        return evaluate
 
-            if len(field_type_parts) > 2:
-                if field_type_parts[2] == 'json':
-                    return dt.strftime('%Y-%m-%dT%H:%M:%S')
-                raise Exception('Invalid datetime value formatter')
+    return lambda ctx: ctx['parser']._find_json(keys)
 
-            return dt
 
-        raise Exception('Unknown field type: %s' % field_type)
+# CONST and FIELD accessors are provided by the template compiler.
+# Subfields are only evaluated against the import model, never the current row.
+template_compiler = TemplateCompiler({
+    'JSON': _accessor_json,
+}, subfield_context=lambda ctx: {'parser': ctx['parser'], 'model_import': ctx.get('model_import')})
@@ -1,17 +1,16 @@
 import json
-import re
 from argparse import Namespace
+from collections import OrderedDict
 from pathlib import Path
-from typing import Generator, List, Type, Any
+from threading import RLock
+from typing import Generator, List, Type, Any, Dict, Tuple, Union, Callable
 
 import numpy
 from netCDF4 import Dataset, Variable
-from numpy import ndenumerate
 from splashback_data.model.import_check_stage import ImportCheckStage
 from splashback_data.model.import_check_status import ImportCheckStatus
 from splashback_data.model.import_results import ImportResults
 from splashback_data.model.laboratory_object import LaboratoryObject
-from splashback_data.model.model_import import ModelImport
 from splashback_data.model.parameter_object import ParameterObject
 from splashback_data.model.program_object import ProgramObject
 from splashback_data.model.quality_object import QualityObject
@@ -19,35 +18,71 @@ from splashback_data.model.sample_variant_type_object import SampleVariantTypeOb
 from splashback_data.model.sampling_method_object import SamplingMethodObject
 from splashback_data.model.site_object import SiteObject
 
-import timeconverters
-from parser import BaseParser, ParsedMetadata
+from parser import BaseParser, ParsedImports, ParsedMetadata
+from parser.template import CompiledTemplate, FieldContext, FieldEvaluator, TemplateCompiler
+
+# The netCDF and HDF5 libraries are not thread-safe, so datasets are only accessed by one thread at a time,
+# e.g. while the pipeline parses the next path and the main thread evaluates metadata templates.
+# Values are read into caches while holding the lock, so templates are evaluated without it.
+dataset_lock = RLock()
 
 
 class NetcdfParser(BaseParser):
     def __init__(self, path: Path):
         super().__init__(path)
 
-        self._dataset = Dataset(path, 'r')
+        with dataset_lock:
+            self._dataset = Dataset(path, 'r')
         self._mapping = {}
+        self._templates: Dict[str, CompiledTemplate] = {}
+        self._metadata: Dict[Tuple[str, Tuple], Any] = {}
 
-    def _start_silent(self, args: Namespace) -> List[ModelImport]:
-        # Read mapping file
-        with open(args.netcdf_mapping, 'r') as m:
-            self._mapping = json.load(m)
+        self._parameter_name = ''
+        self._parameter_dim_idxs = numpy.empty((0, 0), dtype=int)
+        self._parameter_var_values: Dict[str, numpy.ndarray] = {}
+        self._parameter_converted_values: Dict[Tuple[str, Callable], numpy.ndarray] = {}
 
-        if args.verbose:
-            print('Dataset', self._dataset)
-            print('Mapping', repr(self._mapping))
-            for parameter_var in [self._dataset.variables[v] for v in self._mapping['parameters']]:
-                print('Variable', parameter_var)
+        # Caches of dataset values, so accessors only read each variable and attribute once
+        self._attrs: Dict[str, Any] = {}
+        self._var_attrs: Dict[Tuple[str, str], Any] = {}
+        self._var_data: Dict[str, numpy.ndarray] = OrderedDict()
+        self._var_data_size = 0
+        self._var_data_max_size: Union[int, None] = None
+
+    def _start_silent(self, args: Namespace) -> ParsedImports:
+        self._load_mapping(args)
 
-        self._imports = [r for r in self._parse_imports()]
+        if args.verbose:
+            with dataset_lock:
+                print('Dataset', self._dataset)
+                print('Mapping', repr(self._mapping))
+                for parameter_var in [self._dataset.variables[v] for v in self._mapping['parameters']]:
+                    print('Variable', parameter_var)
+
+        # Create the fields up front, so a path without imports still has them
+        self._imports = ParsedImports(list(self._mapping['templates']['import'].keys()))
+        for mdl in self._parse_imports():
+            self._imports.append(mdl)
         return self._imports
 
+    def restore_silent(self, args: Namespace, imports: ParsedImports) -> None:
+        self._load_mapping(args)
+        self._imports = imports
+
+    def _load_mapping(self, args: Namespace) -> None:
+        # Read mapping file
+        with open(args.netcdf_mapping, 'r') as m:
+            self._mapping = json.load(m)
+        self._templates = template_compiler.compile_templates(self._mapping['templates'])
+        if args.netcdf_cache_size is not None:
+            self._var_data_max_size = args.netcdf_cache_size * 1024 * 1024
+
     def start_metadata_silent(self, results: ImportResults, args: Namespace, metadata: ParsedMetadata = None) \
             -> ParsedMetadata:
         if metadata is None:
             metadata = ParsedMetadata()
+        # Metadata objects are given their remote ids once created, so only share them within one call
+        self._metadata = {}
 
         for message in results['messages']:
             # Filter status
@@ -87,159 +122,185 @@ class NetcdfParser(BaseParser):
 
         return metadata
 
-    def _parse_imports(self) -> Generator[ModelImport, None, None]:
+    def _parse_imports(self) -> Generator[Dict[str, Any], None, None]:
         # Iterate each parameter
         for parameter_var in [self._dataset.variables[v] for v in self._mapping['parameters']
                               if v in self._dataset.variables]:
             parameter_var: Variable = parameter_var
-            parameter_attrs = parameter_var.ncattrs()
-
-            # Iterate every combination of indices
-            for dim_idxs, val in ndenumerate(parameter_var[:]):
-
-                # Filter out-of-bounds values
-                if 'valid_min' in parameter_attrs and val < parameter_var.valid_min:
-                    continue
-                if 'valid_max' in parameter_attrs and val > parameter_var.valid_max:
-                    continue
-
-                # Filter fill values
-                if '_FillValue' in parameter_attrs and val == parameter_var.getncattr('_FillValue'):
-                    continue
-
-                yield self._get_import(parameter_var, dim_idxs, val)
-
-    def _get_import(self, parameter_var: Variable, dim_idxs: List[str], val: float) -> ModelImport:
-        return ModelImport(**{k: self._get_field(v, parameter_var=parameter_var, dim_idxs=dim_idxs, val=val)
-                              for k, v in self._mapping['templates']['import'].items()})
-
-    def _get_metadata(self, type: Type, template_name: str, model_import: ModelImport) -> Any:
-        return type(**{k: self._get_field(v, model_import=model_import)
-                       for k, v in self._mapping['templates'][template_name].items()})
-
-    def _get_field(self, field: str,
-                   parameter_var: Variable = None, dim_idxs: List[str] = None, val: float = None,
-                   model_import: ModelImport = None) -> Any:
-        field_parts = field.split('|')
-
-        exception = None
-        for field_part in field_parts:
-            try:
-                return self._get_field_value(field_part,
-                                             parameter_var=parameter_var, dim_idxs=dim_idxs, val=val,
-                                             model_import=model_import)
-            except Exception as e:
-                exception = e
-
-        raise Exception(f'Failed to get field: {exception}')
-
-    def _get_field_value(self, field: str,
-                         parameter_var: Variable = None, dim_idxs: List[str] = None, val: float = None,
-                         model_import: ModelImport = None) -> Any:
-        # Get kwargs as dict
-        kwargs = dict(locals())
-        del kwargs['self']
-        del kwargs['field']
-
-        # Strip field
-        field = field.strip()
-        if field == '':
-            return ''
-
-        # Get subfields
-        field = re.sub(r'\((.*)\)', lambda match: self._get_field(match.group(1), **kwargs), field)
-
-        # Parse args
-        accessor, *args_list = field.split(' ')
-        field_type = 'str'
-        if args_list[-1][0] == '!':
-            field_type = args_list.pop(-1)[1:]
-        args = ' '.join(args_list)
-        field_value = None
-
-        # ATTR <attr_name>: Get a global attribute value
-        if accessor == 'ATTR':
-            if len(args_list) != 1:
-                raise Exception('Expected one argument for accessor ATTR')
-
-            field_value = self._dataset.getncattr(args_list[0])
-
-        # VARATTR <var_name> <attr_name>: Get a variable attribute value
-        elif accessor == 'VARATTR':
-            if len(args_list) != 2:
-                raise Exception('Expected two arguments for accessor VARATTR')
-
-            var: Variable = self._dataset.variables[args_list[0]]
-            field_value = var.getncattr(args_list[1])
-
-        # CONST <values...>: Constant value
-        elif accessor == 'CONST':
-            field_value = args
-
-        # PARAM name|value: Get parameter name or value (import template only)
-        elif accessor == 'PARAM':
-            if parameter_var is None or val is None:
-                raise Exception('Cannot use accessor PARAM in this context')
-
-            if args == 'name':
-                field_value = parameter_var.name
-            if args == 'value':
-                field_value = val
-
-        # VAR <var_name>: Get variable value
-        elif accessor == 'VAR':
-            if dim_idxs is None or parameter_var is None:
-                raise Exception('Cannot use accessor VAR in this context')
+            with dataset_lock:
+                self._parameter_name = parameter_var.name
+                parameter_attrs = {a: parameter_var.getncattr(a) for a in ['valid_min', 'valid_max', '_FillValue']
+                                   if a in parameter_var.ncattrs()}
+                parameter_values = numpy.asarray(parameter_var[:])
+
+            # Mask every combination of indices
+            mask = numpy.ones(parameter_values.shape, dtype=bool)
+
+            # Filter out-of-bounds values
+            if 'valid_min' in parameter_attrs:
+                mask &= ~(parameter_values < parameter_attrs['valid_min'])
+            if 'valid_max' in parameter_attrs:
+                mask &= ~(parameter_values > parameter_attrs['valid_max'])
+
+            # Filter fill values
+            if '_FillValue' in parameter_attrs:
+                mask &= ~(parameter_values == parameter_attrs['_FillValue'])
+
+            # Only generate imports for the remaining indices, in the same order as numpy.ndenumerate
+            self._parameter_dim_idxs = numpy.argwhere(mask)
+            self._parameter_var_values = {}
+            self._parameter_converted_values = {}
+            for row, val in enumerate(parameter_values[mask]):
+                yield self._get_import(parameter_var, row, val)
+
+    def _get_var_values(self, var_name: str, parameter_var: Variable) -> numpy.ndarray:
+        # Get the variable value for every row of the current parameter, using the dimensions they share
+        var_values = self._parameter_var_values.get(var_name)
+        if var_values is None:
+            var: Variable = self._dataset.variables[var_name]
+            var_data = self._get_var_data(var_name)
+            with dataset_lock:
+                var_dims = var.dimensions
+                parameter_dims = parameter_var.dimensions
+            var_idxs = tuple(self._parameter_dim_idxs[:, idx] for idx, dim in enumerate(parameter_dims)
+                             if dim in var_dims)
+
+            if len(var_idxs) == 0:
+                var_values = numpy.broadcast_to(var_data, (len(self._parameter_dim_idxs),) + var_data.shape)
+            else:
+                var_values = var_data[var_idxs]
+            self._parameter_var_values[var_name] = var_values
+        return var_values
+
+    def _get_converted_var_values(self, var_name: str, parameter_var: Variable,
+                                  convert_array: Callable[[numpy.ndarray], numpy.ndarray]) -> numpy.ndarray:
+        # Convert the variable values of every row of the current parameter at once
+        key = (var_name, convert_array)
+        converted_values = self._parameter_converted_values.get(key)
+        if converted_values is None:
+            converted_values = convert_array(self._get_var_values(var_name, parameter_var))
+            self._parameter_converted_values[key] = converted_values
+        return converted_values
+
+    def _get_attr(self, attr_name: str) -> Any:
+        if attr_name not in self._attrs:
+            with dataset_lock:
+                self._attrs[attr_name] = self._dataset.getncattr(attr_name)
+        return self._attrs[attr_name]
+
+    def _get_var_attr(self, var_name: str, attr_name: str) -> Any:
+        key = (var_name, attr_name)
+        if key not in self._var_attrs:
+            with dataset_lock:
+                self._var_attrs[key] = self._dataset.variables[var_name].getncattr(attr_name)
+        return self._var_attrs[key]
+
+    def _get_var_data(self, var_name: str) -> numpy.ndarray:
+        var_data = self._var_data.get(var_name)
+        if var_data is not None:
+            self._var_data.move_to_end(var_name)
+            return var_data
+
+        with dataset_lock:
+            var_data = numpy.ma.getdata(self._dataset.variables[var_name][:])
+
+        # Variables larger than the cache are read every time they are used
+        if self._var_data_max_size is not None and var_data.nbytes > self._var_data_max_size:
+            return var_data
+
+        # Evict least recently used variables until the new variable fits
+        self._var_data_size += var_data.nbytes
+        while self._var_data_max_size is not None and self._var_data_size > self._var_data_max_size:
+            _, evicted_data = self._var_data.popitem(last=False)
+            self._var_data_size -= evicted_data.nbytes
+
+        self._var_data[var_name] = var_data
+        return var_data
+
+    def _get_import(self, parameter_var: Variable, row: int, val: float) -> Dict[str, Any]:
+        ctx = {'parser': self, 'parameter_var': parameter_var, 'row': row, 'val': val}
+        return self._templates['import'](ctx)
+
+    def _get_metadata(self, type: Type, template_name: str, model_import: Dict[str, Any]) -> Any:
+        # Only evaluate each distinct metadata template once, as many messages reference the same metadata
+        template = self._templates[template_name]
+        model_key = template.get_model_key(model_import)
+        if model_key is None:
+            return type(**template({'parser': self, 'model_import': model_import}))
+
+        key = (template_name, model_key)
+        metadata = self._metadata.get(key)
+        if metadata is None:
+            metadata = type(**template({'parser': self, 'model_import': model_import}))
+            self._metadata[key] = metadata
+        return metadata
 
-            var: Variable = self._dataset.variables[args_list[0]]
-            var_idxs = [dim_idxs[idx] for idx, dim in enumerate(parameter_var.dimensions) if dim in var.dimensions]
-            field_value = var[tuple(var_idxs)].data
 
-        # FIELD <field_name>: Get import field (metadata templates only)
-        elif accessor == 'FIELD':
-            if len(args_list) != 1:
-                raise Exception('Expected one argument for accessor FIELD')
-            if model_import is None:
-                raise Exception('Cannot use accessor FIELD in this context')
+# ATTR <attr_name>: Get a global attribute value
+def _accessor_attr(args_list: List[str], args: str) -> FieldEvaluator:
+    if len(args_list) != 1:
+        raise Exception('Expected one argument for accessor ATTR')
+    attr_name = args_list[0]
 
-            field_value = model_import[args_list[0]]
+    return lambda ctx: ctx['parser']._get_attr(attr_name)
 
-        else:
-            raise Exception('Unknown accessor: %s' % accessor)
 
-        if field_value is None:
-            raise Exception('Field value not set')
+# VARATTR <var_name> <attr_name>: Get a variable attribute value
+def _accessor_varattr(args_list: List[str], args: str) -> FieldEvaluator:
+    if len(args_list) != 2:
+        raise Exception('Expected two arguments for accessor VARATTR')
+    var_name, attr_name = args_list
 
-        # Convert to correct type and return
-        field_type_parts = field_type.split(':')
+    return lambda ctx: ctx['parser']._get_var_attr(var_name, attr_name)
 
-        if field_type_parts[0] == 'str':
-            if isinstance(field_value, float) or isinstance(field_value, numpy.float32) \
-                    or isinstance(field_value, numpy.ndarray):
-                field_str_value = f'{field_value:.30f}'
-            else:
-                field_str_value = str(field_value)
 
-            if len(field_type_parts) == 1:
-                return field_str_value
-            return field_str_value[0:int(field_type_parts[1])]
+# PARAM name|value: Get parameter name or value (import template only)
+def _accessor_param(args_list: List[str], args: str) -> FieldEvaluator:
+    def evaluate(ctx: FieldContext) -> Any:
+        parameter_var: Variable = ctx.get('parameter_var')
+        val = ctx.get('val')
+        if parameter_var is None or val is None:
+            raise Exception('Cannot use accessor PARAM in this context')
+
+        if args == 'name':
+            return ctx['parser']._parameter_name
+        if args == 'value':
+            return val
 
-        elif field_type_parts[0] == 'float':
-            return float(field_value)
+    return evaluate
+
+
+# VAR <var_name>: Get variable value
+def _accessor_var(args_list: List[str], args: str) -> FieldEvaluator:
+    var_name = args_list[0]
+
+    def evaluate(ctx: FieldContext) -> Any:
+        parameter_var: Variable = ctx.get('parameter_var')
+        row = ctx.get('row')
+        if row is None or parameter_var is None:
+            raise Exception('Cannot use accessor VAR in this context')
+
+        return ctx['parser']._get_var_values(var_name, parameter_var)[row]
+
+    def with_array_converter(convert_array: Callable[[numpy.ndarray], numpy.ndarray]) -> FieldEvaluator:
+        def evaluate_converted(ctx: FieldContext) -> Any:
+            parameter_var: Variable = ctx.get('parameter_var')
+            row = ctx.get('row')
+            if row is None or parameter_var is None:
+                raise Exception('Cannot use accessor VAR in this context')
 
-        elif field_type_parts[0] == 'datetime':
-            dt = None
-            if field_type_parts[1] == 'days_since_1950':
-                dt = timeconverters.convert_days_since_1950_to_datetime(float(field_value))
+            return ctx['parser']._get_converted_var_values(var_name, parameter_var, convert_array)[row]
 
-            if dt is None:
-                raise Exception('Invalid datetime value type parser')
+        return evaluate_converted
 
-            if len(field_type_parts) > 2:
-                if field_type_parts[2] == 'json':
-                    return dt.strftime('%Y-%m-%dT%H:%M:%S')
-                raise Exception('Invalid datetime value formatter')
+    evaluate.with_array_converter = with_array_converter
+    return evaluate
 
-            return dt
 
-        raise Exception('Unknown field type: %s' % field_type)
+# CONST and FIELD accessors are provided by the template compiler.
+template_compiler = TemplateCompiler({
+    'ATTR': _accessor_attr,
+    'VARATTR': _accessor_varattr,
+    'PARAM': _accessor_param,
+    'VAR': _accessor_var,
+})
@@ -0,0 +1,289 @@
+import re
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, List, Set, Tuple, Union
+
+import numpy
+
+import timeconverters
+
+# A field context holds whatever the accessors of a parser need to evaluate a field, e.g. the current row.
+FieldContext = Dict[str, Any]
+FieldEvaluator = Callable[[FieldContext], Any]
+# An accessor factory takes the split arguments and the joined argument string of a field expression.
+AccessorFactory = Callable[[List[str], str], FieldEvaluator]
+
+datetime_parsers = {
+    'days_since_1950': lambda v: timeconverters.convert_days_since_1950_to_datetime(float(v)),
+    'bom_date_time_full': timeconverters.convert_bom_date_time_full_to_datetime,
+}
+# Datetime parsers that convert a whole array of values at once
+datetime_array_parsers = {
+    'days_since_1950': timeconverters.convert_days_since_1950_to_datetime64,
+}
+# Number of formatted datetimes cached by each datetime field type, as rows often repeat the same timestamps
+datetime_cache_size = 65536
+
+
+def _raise(exception: Exception) -> FieldEvaluator:
+    def evaluate(ctx: FieldContext) -> Any:
+        raise exception
+
+    return evaluate
+
+
+def _format_float(field_value: Any) -> str:
+    # Format with the fewest digits that read back as the same value of its own dtype, e.g. float32 0.1 as 0.1
+    # rather than 0.100000001490116119384765625. Exponents are written out in full, as values are decimal strings.
+    field_str = str(field_value)
+    if 'e' in field_str:
+        return numpy.format_float_positional(field_value, unique=True, trim='0')
+    return field_str
+
+
+def _format_str(field_value: Any) -> str:
+    if isinstance(field_value, numpy.ndarray):
+        if field_value.ndim != 0:
+            raise Exception('Cannot format an array as a string')
+        field_value = field_value[()]
+    if isinstance(field_value, float) or isinstance(field_value, numpy.floating):
+        return _format_float(field_value)
+    return str(field_value)
+
+
+def _convert_datetime_array(dt_array_parser: Callable[[numpy.ndarray], numpy.ndarray],
+                            values: numpy.ndarray) -> numpy.ndarray:
+    # Values that can't be converted are None, so they are converted alone to raise the parser's error
+    if values.ndim != 1:
+        return numpy.full(values.shape[0:1], None, dtype=object)
+    dt_values = dt_array_parser(values)
+    formatted_values = timeconverters.format_datetime64_json(dt_values).astype(object)
+    formatted_values[numpy.isnat(dt_values)] = None
+    return formatted_values
+
+
+def _compile_converter(field_type: str) -> Callable[[Any], Any]:
+    field_type_parts = field_type.split(':')
+
+    if field_type_parts[0] == 'str':
+        if len(field_type_parts) == 1:
+            return _format_str
+        length = int(field_type_parts[1])
+        return lambda v: _format_str(v)[0:length]
+
+    elif field_type_parts[0] == 'float':
+        return float
+
+    elif field_type_parts[0] == 'datetime':
+        dt_parser = datetime_parsers.get(field_type_parts[1])
+        if dt_parser is None:
+            raise Exception('Invalid datetime value type parser')
+
+        if len(field_type_parts) > 2:
+            if field_type_parts[2] == 'json':
+                convert = lru_cache(maxsize=datetime_cache_size)(lambda v: dt_parser(v).strftime('%Y-%m-%dT%H:%M:%S'))
+                dt_array_parser = datetime_array_parsers.get(field_type_parts[1])
+                if dt_array_parser is not None:
+                    convert.convert_array = partial(_convert_datetime_array, dt_array_parser)
+                return convert
+            raise Exception('Invalid datetime value formatter')
+
+        return dt_parser
+
+    raise Exception('Unknown field type: %s' % field_type)
+
+
+def _accessor_const(args_list: List[str], args: str) -> FieldEvaluator:
+    return lambda ctx: args
+
+
+def _accessor_field(args_list: List[str], args: str) -> FieldEvaluator:
+    if len(args_list) != 1:
+        raise Exception('Expected one argument for accessor FIELD')
+    name = args_list[0]
+
+    def evaluate(ctx: FieldContext) -> Any:
+        model_import = ctx.get('model_import')
+        if model_import is None:
+            raise Exception('Cannot use accessor FIELD in this context')
+        return model_import[name]
+
+    return evaluate
+
+
+class CompiledTemplate:
+    def __init__(self, fields: List[Tuple[str, FieldEvaluator]], model_fields: Union[Tuple[str, ...], None] = None):
+        self._fields = fields
+        self._model_fields = model_fields
+
+    def __call__(self, ctx: FieldContext) -> Dict[str, Any]:
+        return {k: evaluate(ctx) for k, evaluate in self._fields}
+
+    def get_model_key(self, model_import: Any) -> Union[Tuple, None]:
+        # Outside of a row, a template only depends on its parser and the model fields it reads with FIELD.
+        # Models with equal keys give equal values, or None if the fields read are unknown.
+        if self._model_fields is None:
+            return None
+        # Models missing a field, or with unhashable values, aren't keyed, so the template's fallbacks still apply.
+        # Values are keyed with their type, as e.g. 1 and True are equal but aren't formatted the same.
+        try:
+            model_key = tuple((type(v), v) for v in (model_import[f] for f in self._model_fields))
+            hash(model_key)
+        except (KeyError, TypeError):
+            return None
+        return model_key
+
+
+# Compiles mapping field expressions (ACCESSOR args... !type | fallback) into evaluators once, so templates can be
+# applied to every row without re-parsing them. Expression errors are raised on evaluation, as fallbacks rely on them.
+class TemplateCompiler:
+    def __init__(self, accessors: Dict[str, AccessorFactory],
+                 subfield_context: Callable[[FieldContext], FieldContext] = None):
+        self._accessors: Dict[str, AccessorFactory] = {'CONST': _accessor_const, 'FIELD': _accessor_field}
+        self._accessors.update(accessors)
+        self._subfield_context = subfield_context
+        self._fields: Dict[str, FieldEvaluator] = {}
+        self._expressions: Dict[str, FieldEvaluator] = {}
+
+    def compile_templates(self, templates: Dict[str, Dict[str, str]]) -> Dict[str, CompiledTemplate]:
+        return {name: self.compile_template(template) for name, template in templates.items()}
+
+    def compile_template(self, template: Dict[str, str]) -> CompiledTemplate:
+        model_fields = set()
+        for field in template.values():
+            field_model_fields = self.get_model_fields(field)
+            if field_model_fields is None:
+                model_fields = None
+                break
+            model_fields |= field_model_fields
+
+        return CompiledTemplate([(k, self.compile_field(v)) for k, v in template.items()],
+                                None if model_fields is None else tuple(sorted(model_fields)))
+
+    def get_model_fields(self, field: str) -> Union[Set[str], None]:
+        # Find the model fields read by FIELD accessors, or None if a field name is only known once evaluated
+        model_fields = set()
+        for field_part in field.split('|'):
+            field_part = field_part.strip()
+
+            match = re.search(r'\((.*)\)', field_part)
+            if match is not None:
+                if field_part[0:match.start()].split(' ')[0] == 'FIELD':
+                    return None
+                subfield_model_fields = self.get_model_fields(match.group(1))
+                if subfield_model_fields is None:
+                    return None
+                model_fields |= subfield_model_fields
+
+            else:
+                accessor, *args_list = field_part.split(' ')
+                if accessor == 'FIELD' and len(args_list) > 0:
+                    model_fields.add(args_list[0])
+
+        return model_fields
+
+    def compile_field(self, field: str) -> FieldEvaluator:
+        evaluator = self._fields.get(field)
+        if evaluator is None:
+            evaluator = self._compile_field(field)
+            self._fields[field] = evaluator
+        return evaluator
+
+    def _compile_field(self, field: str) -> FieldEvaluator:
+        field_parts = [self._compile_field_part(p) for p in field.split('|')]
+        if len(field_parts) == 1:
+            first_part = field_parts[0]
+
+            def evaluate(ctx: FieldContext) -> Any:
+                try:
+                    return first_part(ctx)
+                except Exception as e:
+                    raise Exception(f'Failed to get field: {e}')
+
+            return evaluate
+
+        def evaluate(ctx: FieldContext) -> Any:
+            exception = None
+            for field_part in field_parts:
+                try:
+                    return field_part(ctx)
+                except Exception as e:
+                    exception = e
+
+            raise Exception(f'Failed to get field: {exception}')
+
+        return evaluate
+
+    def _compile_field_part(self, field: str) -> FieldEvaluator:
+        # Strip field
+        field = field.strip()
+        if field == '':
+            return lambda ctx: ''
+
+        # Subfields are substituted into the expression, so it can only be compiled once they are known
+        match = re.search(r'\((.*)\)', field)
+        if match is not None:
+            prefix, suffix = field[0:match.start()], field[match.end():]
+            subfield = self.compile_field(match.group(1))
+            subfield_context = self._subfield_context
+
+            def evaluate(ctx: FieldContext) -> Any:
+                subfield_value = subfield(ctx if subfield_context is None else subfield_context(ctx))
+                return self._compile_expression(prefix + subfield_value + suffix)(ctx)
+
+            return evaluate
+
+        return self._compile_expression(field)
+
+    def _compile_expression(self, expression: str) -> FieldEvaluator:
+        evaluator = self._expressions.get(expression)
+        if evaluator is None:
+            try:
+                evaluator = self._compile_accessor(expression)
+            except Exception as e:
+                evaluator = _raise(e)
+            self._expressions[expression] = evaluator
+        return evaluator
+
+    def _compile_accessor(self, expression: str) -> FieldEvaluator:
+        # Parse args
+        accessor, *args_list = expression.split(' ')
+        field_type = 'str'
+        if args_list[-1][0] == '!':
+            field_type = args_list.pop(-1)[1:]
+        args = ' '.join(args_list)
+
+        accessor_factory = self._accessors.get(accessor)
+        if accessor_factory is None:
+            raise Exception('Unknown accessor: %s' % accessor)
+        get_value = accessor_factory(args_list, args)
+
+        try:
+            convert = _compile_converter(field_type)
+        except Exception as e:
+            # Conversion errors are only raised once a value has been found
+            def convert(v: Any, exception: Exception = e) -> Any:
+                raise exception
+
+        def evaluate(ctx: FieldContext) -> Any:
+            field_value = get_value(ctx)
+            if field_value is None:
+                raise Exception('Field value not set')
+
+            # Convert to correct type and return
+            return convert(field_value)
+
+        # Accessors of arrays of values may convert every value at once, if the converter supports it
+        convert_array = getattr(convert, 'convert_array', None)
+        with_array_converter = getattr(get_value, 'with_array_converter', None)
+        if convert_array is not None and with_array_converter is not None:
+            get_converted_value = with_array_converter(convert_array)
+
+            def evaluate_converted(ctx: FieldContext) -> Any:
+                converted_value = get_converted_value(ctx)
+                if converted_value is None:
+                    return evaluate(ctx)
+                return converted_value
+
+            return evaluate_converted
+
+        return evaluate
@@ -0,0 +1,56 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+_done = object()
+
+
+def threaded(iterable: Iterable[T], maxsize: int = 1) -> Iterator[T]:
+    # Consume the iterable in a background thread, buffering at most maxsize items ahead of the caller
+    items: Queue = Queue(maxsize=max(maxsize, 1))
+    stopped = Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_done, None))
+        except BaseException as e:
+            put((_done, e))
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            try:
+                item, exception = items.get(timeout=0.1)
+            except Empty:
+                if thread.is_alive():
+                    continue
+                # The producer may have put its last item just before stopping
+                try:
+                    item, exception = items.get_nowait()
+                except Empty:
+                    raise Exception('Pipeline stage stopped unexpectedly')
+
+            if exception is not None:
+                raise exception
+            if item is _done:
+                return
+            yield item
+    finally:
+        # Stop the producer if the caller stops early or fails
+        stopped.set()
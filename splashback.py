@@ -1,4 +1,10 @@
-from typing import Generator, List, Tuple
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+from threading import Lock
+from typing import Generator, List, Tuple, Union, Dict, Any, Callable
 
 import splashback_data
 from splashback_data.api import imports_api, sites_api, site_lookups_api, programs_api, program_lookups_api, \
@@ -10,180 +16,304 @@ from splashback_data.model.import_results import ImportResults
 from splashback_data.model.import_run_result import ImportRunResult
 from splashback_data.model.lookup_object import LookupObject
 from splashback_data.model.model_import import ModelImport
+from splashback_data.model.sample_variant_type_object import SampleVariantTypeObject
 
-import listutils
-from parser import ParsedMetadata
+from listutils import UniqueList
+from parser import ParsedImports, ParsedMetadata
 
 # Setup Splashback API configuration
 splashback_host = 'https://api.splashback.io'
+compress_min_size = 1024
+
+
+class RemoteMetadataCache:
+    def __init__(self, path: Path = None):
+        self._path = path
+        self._lock = Lock()
+        self._changed = False
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        if path is not None and path.exists():
+            with path.open('r') as f:
+                self._entries = json.load(f)
+        self._entities: Dict[str, UniqueList] = {}
+
+    def get(self, kind: str, unique_fields: List[str], fetch: Callable[[], List[Any]]) -> UniqueList:
+        with self._lock:
+            entities = self._entities.get(kind)
+            if entities is None:
+                entries = self._entries.get(kind)
+                if entries is None:
+                    entries = [self._get_entry(e, unique_fields) for e in fetch()]
+                    self._entries[kind] = entries
+                    self._changed = True
+
+                entities = UniqueList(unique_fields, entries)
+                self._entities[kind] = entities
+            return entities
+
+    def add(self, kind: str, unique_fields: List[str], entity: Any) -> None:
+        with self._lock:
+            entry = self._get_entry(entity, unique_fields)
+            self._entries[kind].append(entry)
+            self._entities[kind].add(entry)
+            self._changed = True
+
+    @staticmethod
+    def _get_entry(entity: Any, unique_fields: List[str]) -> Dict[str, Any]:
+        # Only keep what is needed to find entities and reference them
+        return {f: entity[f] for f in unique_fields + ['id']}
+
+    def save(self) -> None:
+        with self._lock:
+            if self._path is None or not self._changed:
+                return
+
+            tmp_path = self._path.with_name(self._path.name + '.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(self._entries, f)
+            tmp_path.replace(self._path)
+            self._changed = False
 
 
 class SplashbackImporter:
-    def __init__(self, api_key: str, pool_id: str):
+    def __init__(self, api_key: str, pool_id: str, connection_pool_size: int = None, compress: bool = False,
+                 metadata_workers: int = 1, metadata_cache_path: Path = None):
         self._configuration = splashback_data.Configuration(
             host=splashback_host + '/data'
         )
         self._configuration.api_key['api-key'] = api_key
         self._configuration.api_key_prefix['api-key'] = 'API-Key'
+        if connection_pool_size is not None:
+            self._configuration.connection_pool_maxsize = connection_pool_size
 
         self._pool_id = pool_id
+        self._metadata_workers = max(metadata_workers, 1)
+
+        # Share one client, so connections are kept alive and reused across requests
+        self._client = splashback_data.ApiClient(self._configuration)
+        if compress:
+            self._compress_requests()
+
+        # Whether metadata has been created since the last check, making its results stale
+        self._metadata_created = False
+        # Remote metadata is only fetched once, as it is only changed by the importer while it runs
+        self._remote_metadata = RemoteMetadataCache(metadata_cache_path)
+
+    def __enter__(self) -> 'SplashbackImporter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._client.close()
 
     @property
     def pool_id(self) -> int:
         return int(self._pool_id)
 
-    def check(self, imports: List[ModelImport]) -> ImportResults:
-        with splashback_data.ApiClient(self._configuration) as client:
-            instance = imports_api.ImportsApi(client)
-
-            results: ImportResults = instance.api_imports_check_pool_id_post(model_import=imports,
-                                                                             pool_id=self.pool_id)
-
+    def _compress_requests(self) -> None:
+        # Gzip request bodies, which are mostly large import payloads
+        pool_manager = self._client.rest_client.pool_manager
+        request = pool_manager.request
+
+        def compressed_request(method: str, url: str, body: Union[str, bytes] = None, headers: Dict = None,
+                               **kwargs) -> Any:
+            if body is not None and len(body) >= compress_min_size:
+                body = gzip.compress(body.encode('utf-8') if isinstance(body, str) else body)
+                headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+            return request(method, url, body=body, headers=headers, **kwargs)
+
+        pool_manager.request = compressed_request
+
+    def get_connection_stats(self) -> Tuple[int, int]:
+        # Count requests made and connections opened, where fewer connections means more reuse
+        pools = self._client.rest_client.pool_manager.pools
+        request_count = 0
+        connection_count = 0
+        for key in pools.keys():
+            pool = pools[key]
+            request_count += pool.num_requests
+            connection_count += pool.num_connections
+        return request_count, connection_count
+
+    @staticmethod
+    def _get_payload(imports: ParsedImports) -> List[Dict[str, Any]]:
+        # Serialize imports straight to their JSON fields, rather than creating and validating a model for each
+        keys = [ModelImport.attribute_map[f] for f in imports.fields]
+        return [dict(zip(keys, values)) for values in imports.iter_values()]
+
+    def check(self, imports: ParsedImports) -> ImportResults:
+        instance = imports_api.ImportsApi(self._client)
+        results: ImportResults = instance.api_imports_check_pool_id_post(model_import=self._get_payload(imports),
+                                                                         pool_id=self.pool_id,
+                                                                         _check_input_type=False)
+
+        self._metadata_created = False
         return results
 
     def create_metadata(self, metadata: ParsedMetadata) -> Generator[Tuple[str, int, int], None, None]:
+        # Save the entities created so far even if creating the rest fails, so they aren't created again
+        try:
+            yield from self._create_metadata(metadata)
+        finally:
+            self._remote_metadata.save()
+
+    def _create_metadata(self, metadata: ParsedMetadata) -> Generator[Tuple[str, int, int], None, None]:
         # TODO: Create endpoints do not return metadata pre-v2 Splashback!
 
-        with splashback_data.ApiClient(self._configuration) as client:
+        with ThreadPoolExecutor(max_workers=self._metadata_workers) as executor:
             # region Sites
-            site_instance = sites_api.SitesApi(client)
-            remote_sites = site_instance.api_sites_pool_id_get(pool_id=self.pool_id)
-            for site_idx, site in enumerate(metadata.sites):
-                remote_site = listutils.get_unique_value(remote_sites, ['name', 'location'], site)
-                if remote_site is None:
-                    remote_site = site_instance.api_sites_pool_id_post(site_object=site, pool_id=self.pool_id)
-
-                site['id'] = remote_site['id']
-                yield 'sites', site_idx + 1, len(metadata.sites)
-
-            site_lookup_instance = site_lookups_api.SiteLookupsApi(client)
-            site_lookups = metadata.get_lookups('sites')
-            for lookup_idx, (key, idx) in enumerate(site_lookups):
-                lookup = LookupObject(id=metadata.sites[idx]['id'], key=key, pool_id=self.pool_id)
-
-                site_lookup_instance.api_site_lookups_pool_id_post(lookup_object=lookup, pool_id=self.pool_id)
-                yield 'site lookups', lookup_idx + 1, len(site_lookups)
+            site_instance = sites_api.SitesApi(self._client)
+            yield from self._create_entities(
+                executor, 'sites', 'sites', metadata.sites, ['name', 'location'],
+                lambda: site_instance.api_sites_pool_id_get(pool_id=self.pool_id),
+                lambda site: site_instance.api_sites_pool_id_post(site_object=site, pool_id=self.pool_id))
+
+            site_lookup_instance = site_lookups_api.SiteLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'site lookups', metadata.get_lookups('sites'), metadata.sites,
+                lambda lookup: site_lookup_instance.api_site_lookups_pool_id_post(lookup_object=lookup,
+                                                                                  pool_id=self.pool_id))
             # endregion
 
             # region Programs
-            program_instance = programs_api.ProgramsApi(client)
-            remote_programs = program_instance.api_programs_pool_id_get(pool_id=self.pool_id)
-            for program_idx, program in enumerate(metadata.programs):
-                remote_program = listutils.get_unique_value(remote_programs, ['name'], program)
-                if remote_program is None:
-                    remote_program = program_instance.api_programs_pool_id_post(program_object=program,
-                                                                                pool_id=self.pool_id)
-
-                program['id'] = remote_program['id']
-                yield 'program', program_idx + 1, len(metadata.programs)
-
-            program_lookup_instance = program_lookups_api.ProgramLookupsApi(client)
-            program_lookups = metadata.get_lookups('programs')
-            for lookup_idx, (key, idx) in enumerate(program_lookups):
-                lookup = LookupObject(id=metadata.programs[idx]['id'], key=key, pool_id=self.pool_id)
-
-                program_lookup_instance.api_program_lookups_pool_id_post(lookup_object=lookup, pool_id=self.pool_id)
-                yield 'program lookups', lookup_idx + 1, len(program_lookups)
+            program_instance = programs_api.ProgramsApi(self._client)
+            yield from self._create_entities(
+                executor, 'program', 'programs', metadata.programs, ['name'],
+                lambda: program_instance.api_programs_pool_id_get(pool_id=self.pool_id),
+                lambda program: program_instance.api_programs_pool_id_post(program_object=program,
+                                                                           pool_id=self.pool_id))
+
+            program_lookup_instance = program_lookups_api.ProgramLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'program lookups', metadata.get_lookups('programs'), metadata.programs,
+                lambda lookup: program_lookup_instance.api_program_lookups_pool_id_post(lookup_object=lookup,
+                                                                                        pool_id=self.pool_id))
             # endregion
 
             # region Variant Types
-            variant_type_instance = sample_variant_types_api.SampleVariantTypesApi(client)
-            for variant_type_idx, variant_type in enumerate(metadata.variant_types):
+            variant_type_instance = sample_variant_types_api.SampleVariantTypesApi(self._client)
+
+            def create_variant_type(variant_type: SampleVariantTypeObject) -> None:
+                self._metadata_created = True
                 variant_type_instance.api_sample_variant_types_pool_id_post(sample_variant_type_object=variant_type,
                                                                             pool_id=self.pool_id)
-                yield 'variant type', variant_type_idx + 1, len(metadata.variant_types)
+
+            yield from self._run_concurrently(executor, 'variant type',
+                                              [partial(create_variant_type, v) for v in metadata.variant_types])
             # endregion
 
             # region Parameters
-            parameter_instance = parameters_api.ParametersApi(client)
-            remote_parameters = parameter_instance.api_parameters_pool_id_get(pool_id=self.pool_id)
-            for parameter_idx, parameter in enumerate(metadata.parameters):
-                remote_parameter = listutils.get_unique_value(remote_parameters, ['name', 'unit'], parameter)
-                if remote_parameter is None:
-                    remote_parameter = parameter_instance.api_parameters_pool_id_post(parameter_object=parameter,
-                                                                                      pool_id=self.pool_id)
-
-                parameter['id'] = remote_parameter['id']
-                yield 'parameter', parameter_idx + 1, len(metadata.parameters)
-
-            parameter_lookup_instance = parameter_lookups_api.ParameterLookupsApi(client)
-            parameter_lookups = metadata.get_lookups('parameters')
-            for lookup_idx, (key, idx) in enumerate(parameter_lookups):
-                lookup = LookupObject(id=metadata.parameters[idx]['id'], key=key, pool_id=self.pool_id)
-
-                parameter_lookup_instance.api_parameter_lookups_pool_id_post(lookup_object=lookup, pool_id=self.pool_id)
-                yield 'parameter lookups', lookup_idx + 1, len(parameter_lookups)
+            parameter_instance = parameters_api.ParametersApi(self._client)
+            yield from self._create_entities(
+                executor, 'parameter', 'parameters', metadata.parameters, ['name', 'unit'],
+                lambda: parameter_instance.api_parameters_pool_id_get(pool_id=self.pool_id),
+                lambda parameter: parameter_instance.api_parameters_pool_id_post(parameter_object=parameter,
+                                                                                 pool_id=self.pool_id))
+
+            parameter_lookup_instance = parameter_lookups_api.ParameterLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'parameter lookups', metadata.get_lookups('parameters'), metadata.parameters,
+                lambda lookup: parameter_lookup_instance.api_parameter_lookups_pool_id_post(lookup_object=lookup,
+                                                                                            pool_id=self.pool_id))
             # endregion
 
             # region Laboratories
-            laboratory_instance = laboratories_api.LaboratoriesApi(client)
-            remote_laboratories = laboratory_instance.api_laboratories_pool_id_get(pool_id=self.pool_id)
-            for laboratory_idx, laboratory in enumerate(metadata.laboratories):
-                remote_laboratory = listutils.get_unique_value(remote_laboratories, ['name'], laboratory)
-                if remote_laboratory is None:
-                    remote_laboratory = laboratory_instance.api_laboratories_pool_id_post(laboratory_object=laboratory,
-                                                                                          pool_id=self.pool_id)
-
-                laboratory['id'] = remote_laboratory['id']
-                yield 'laboratory', laboratory_idx + 1, len(metadata.laboratories)
-
-            laboratory_lookup_instance = laboratory_lookups_api.LaboratoryLookupsApi(client)
-            laboratory_lookups = metadata.get_lookups('laboratories')
-            for lookup_idx, (key, idx) in enumerate(laboratory_lookups):
-                lookup = LookupObject(id=metadata.laboratories[idx]['id'], key=key, pool_id=self.pool_id)
-
-                laboratory_lookup_instance.api_laboratory_lookups_pool_id_post(lookup_object=lookup,
-                                                                               pool_id=self.pool_id)
-                yield 'laboratory lookups', lookup_idx + 1, len(laboratory_lookups)
+            laboratory_instance = laboratories_api.LaboratoriesApi(self._client)
+            yield from self._create_entities(
+                executor, 'laboratory', 'laboratories', metadata.laboratories, ['name'],
+                lambda: laboratory_instance.api_laboratories_pool_id_get(pool_id=self.pool_id),
+                lambda laboratory: laboratory_instance.api_laboratories_pool_id_post(laboratory_object=laboratory,
+                                                                                     pool_id=self.pool_id))
+
+            laboratory_lookup_instance = laboratory_lookups_api.LaboratoryLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'laboratory lookups', metadata.get_lookups('laboratories'), metadata.laboratories,
+                lambda lookup: laboratory_lookup_instance.api_laboratory_lookups_pool_id_post(lookup_object=lookup,
+                                                                                              pool_id=self.pool_id))
             # endregion
 
             # region Sampling Methods
-            sampling_method_instance = sampling_methods_api.SamplingMethodsApi(client)
-            remote_sampling_methods = sampling_method_instance.api_sampling_methods_pool_id_get(pool_id=self.pool_id)
-            for sampling_method_idx, sampling_method in enumerate(metadata.sampling_methods):
-                remote_sampling_method = listutils.get_unique_value(remote_sampling_methods, ['name'], sampling_method)
-                if remote_sampling_method is None:
-                    remote_sampling_method = sampling_method_instance.api_sampling_methods_pool_id_post(
-                        sampling_method_object=sampling_method,
-                        pool_id=self.pool_id)
-
-                sampling_method['id'] = remote_sampling_method['id']
-                yield 'sampling method', sampling_method_idx + 1, len(metadata.sampling_methods)
-
-            sampling_method_lookup_instance = sampling_method_lookups_api.SamplingMethodLookupsApi(client)
-            sampling_method_lookups = metadata.get_lookups('sampling_methods')
-            for lookup_idx, (key, idx) in enumerate(sampling_method_lookups):
-                lookup = LookupObject(id=metadata.sampling_methods[idx]['id'], key=key, pool_id=self.pool_id)
-
-                sampling_method_lookup_instance.api_sampling_method_lookups_pool_id_post(lookup_object=lookup,
-                                                                                         pool_id=self.pool_id)
-                yield 'sampling method lookups', lookup_idx + 1, len(sampling_method_lookups)
+            sampling_method_instance = sampling_methods_api.SamplingMethodsApi(self._client)
+            yield from self._create_entities(
+                executor, 'sampling method', 'sampling_methods', metadata.sampling_methods, ['name'],
+                lambda: sampling_method_instance.api_sampling_methods_pool_id_get(pool_id=self.pool_id),
+                lambda sampling_method: sampling_method_instance.api_sampling_methods_pool_id_post(
+                    sampling_method_object=sampling_method,
+                    pool_id=self.pool_id))
+
+            sampling_method_lookup_instance = sampling_method_lookups_api.SamplingMethodLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'sampling method lookups', metadata.get_lookups('sampling_methods'),
+                metadata.sampling_methods,
+                lambda lookup: sampling_method_lookup_instance.api_sampling_method_lookups_pool_id_post(
+                    lookup_object=lookup,
+                    pool_id=self.pool_id))
             # endregion
 
             # region Qualities
-            quality_instance = qualities_api.QualitiesApi(client)
-            remote_qualities = quality_instance.api_qualities_pool_id_get(pool_id=self.pool_id)
-            for quality_idx, quality in enumerate(metadata.qualities):
-                remote_quality = listutils.get_unique_value(remote_qualities, ['name'], quality)
-                if remote_quality is None:
-                    remote_quality = quality_instance.api_qualities_pool_id_post(quality_object=quality,
-                                                                                 pool_id=self.pool_id)
-
-                quality['id'] = remote_quality['id']
-                yield 'quality', quality_idx + 1, len(metadata.qualities)
-
-            quality_lookup_instance = quality_lookups_api.QualityLookupsApi(client)
-            quality_lookups = metadata.get_lookups('qualities')
-            for lookup_idx, (key, idx) in enumerate(quality_lookups):
-                lookup = LookupObject(id=metadata.qualities[idx]['id'], key=key, pool_id=self.pool_id)
-
-                quality_lookup_instance.api_quality_lookups_pool_id_post(lookup_object=lookup, pool_id=self.pool_id)
-                yield 'quality lookups', lookup_idx + 1, len(quality_lookups)
+            quality_instance = qualities_api.QualitiesApi(self._client)
+            yield from self._create_entities(
+                executor, 'quality', 'qualities', metadata.qualities, ['name'],
+                lambda: quality_instance.api_qualities_pool_id_get(pool_id=self.pool_id),
+                lambda quality: quality_instance.api_qualities_pool_id_post(quality_object=quality,
+                                                                            pool_id=self.pool_id))
+
+            quality_lookup_instance = quality_lookups_api.QualityLookupsApi(self._client)
+            yield from self._create_lookups(
+                executor, 'quality lookups', metadata.get_lookups('qualities'), metadata.qualities,
+                lambda lookup: quality_lookup_instance.api_quality_lookups_pool_id_post(lookup_object=lookup,
+                                                                                        pool_id=self.pool_id))
             # endregion
 
-    def run(self, imports: List[ModelImport],
-            dry_run: bool = False, skip_exist_sample: bool = False) -> ImportRunResult:
-        results = self.check(imports)
+    def _create_entities(self, executor: ThreadPoolExecutor, name: str, kind: str, entities: UniqueList,
+                         unique_fields: List[str], fetch: Callable[[], List[Any]], create: Callable[[Any], Any]) \
+            -> Generator[Tuple[str, int, int], None, None]:
+        remote_entities = self._remote_metadata.get(kind, unique_fields, fetch)
+
+        # Set the remote id of every entity, creating the entities that are not in the pool yet
+        def set_id(entity: Any) -> None:
+            remote_entity = remote_entities.get(entity)
+            if remote_entity is None:
+                self._metadata_created = True
+                remote_entity = create(entity)
+                self._remote_metadata.add(kind, unique_fields, remote_entity)
+
+            entity['id'] = remote_entity['id']
+
+        yield from self._run_concurrently(executor, name, [partial(set_id, e) for e in entities])
+
+    def _create_lookups(self, executor: ThreadPoolExecutor, name: str, lookups: List[Tuple[str, int]],
+                        entities: UniqueList, create: Callable[[LookupObject], Any]) \
+            -> Generator[Tuple[str, int, int], None, None]:
+        # Lookups reference the entity ids, so they can only be created once every entity has its id
+        def create_lookup(key: str, idx: int) -> None:
+            self._metadata_created = True
+            create(LookupObject(id=entities[idx]['id'], key=key, pool_id=self.pool_id))
+
+        yield from self._run_concurrently(executor, name, [partial(create_lookup, k, i) for k, i in lookups])
+
+    @staticmethod
+    def _run_concurrently(executor: ThreadPoolExecutor, name: str, calls: List[Callable[[], None]]) \
+            -> Generator[Tuple[str, int, int], None, None]:
+        # Yield progress as each call completes, so callers see the same progress as when run one at a time
+        futures = [executor.submit(call) for call in calls]
+        try:
+            for idx, future in enumerate(as_completed(futures)):
+                future.result()
+                yield name, idx + 1, len(futures)
+        finally:
+            # Don't start queued calls if one has failed
+            for future in futures:
+                future.cancel()
+
+    def run(self, imports: ParsedImports, dry_run: bool = False, skip_exist_sample: bool = False,
+            check_results: ImportResults = None) -> ImportRunResult:
+        # Reuse the given check results, unless metadata has been created since they were checked
+        results = check_results
+        if results is None or self._metadata_created:
+            results = self.check(imports)
 
         # Skip existing samples
         if skip_exist_sample:
@@ -195,8 +325,11 @@ class SplashbackImporter:
                     continue
                 skip_idxs.add(message['index'])
 
-            imports = [r for idx, r in enumerate(imports) if idx not in skip_idxs]
-            results = self.check(imports)
+            # Skipping imports cannot add errors, so only check the remaining imports if there were errors
+            if len(skip_idxs) > 0:
+                imports = imports.select([idx for idx in range(len(imports)) if idx not in skip_idxs])
+                if results['has_error_message']:
+                    results = self.check(imports)
 
         # Unhandled error messages
         if results['has_error_message']:
@@ -207,7 +340,6 @@ class SplashbackImporter:
             return ImportRunResult(imported_sample_count=0, imported_variant_count=0, imported_value_count=0)
 
         # Perform import
-        with splashback_data.ApiClient(self._configuration) as client:
-            instance = imports_api.ImportsApi(client)
-
-            return instance.api_imports_run_pool_id_post(model_import=imports, pool_id=self.pool_id)
+        instance = imports_api.ImportsApi(self._client)
+        return instance.api_imports_run_pool_id_post(model_import=self._get_payload(imports), pool_id=self.pool_id,
+                                                     _check_input_type=False)
@@ -0,0 +1,70 @@
+import random
+from argparse import Namespace
+from pathlib import Path
+from typing import List, Dict, Any
+
+import pytest
+
+import main
+from parser import BaseParser, ParsedImports, sample_fields
+
+
+class ListParser(BaseParser):
+    def __init__(self, imports: List[Dict[str, Any]]):
+        super().__init__(Path('test'))
+        self._parsed_imports = imports
+
+    def _start_silent(self, args: Namespace) -> ParsedImports:
+        imports = ParsedImports(['site_code', 'date', 'program', 'parameter', 'value'])
+        for mdl in self._parsed_imports:
+            imports.append(mdl)
+        return imports
+
+
+def create_imports(rng: random.Random, sample_count: int) -> List[Dict[str, Any]]:
+    # Imports are ordered by parameter, as NetCDF imports are, so each sample is spread across the path
+    samples = [{'site_code': rng.choice(['a', 'b']), 'date': f'2021-01-{idx + 1:02d}', 'program': 'p'}
+               for idx in range(sample_count)]
+    return [dict(sample, parameter=parameter, value=str(rng.random()))
+            for parameter in ['temp', 'psal', 'depth'] for sample in samples if rng.random() < 0.8]
+
+
+def get_sample_key(mdl: Dict[str, Any]):
+    return tuple(mdl[f] for f in sample_fields)
+
+
+def generate_batches(m_parser: BaseParser, batch_size: int, offset: int = 0) -> List[main.Batch]:
+    main.args = Namespace(batch_size=batch_size, option=None)
+    imports = m_parser.start_silent(main.args)
+    return list(main.generate_batches([(Path('test'), m_parser, imports, offset)]))
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('batch_size', [1, 2, 5, 7, 50])
+def test_split_between_samples(seed: int, batch_size: int):
+    imports = create_imports(random.Random(seed), 20)
+    m_parser = ListParser(imports)
+    batches = generate_batches(m_parser, batch_size)
+
+    # Every import is batched once, and each sample is imported by one batch
+    batched_imports = [mdl for batch in batches for mdl in batch.imports]
+    assert sorted(map(repr, batched_imports)) == sorted(map(repr, imports))
+    sample_batches = {}
+    for batch_idx, batch in enumerate(batches):
+        for mdl in batch.imports:
+            assert sample_batches.setdefault(get_sample_key(mdl), batch_idx) == batch_idx
+
+    # Batches only exceed the batch size to keep a sample together
+    for batch in batches:
+        if len(batch.imports) > batch_size:
+            assert len({get_sample_key(mdl) for mdl in batch.imports}) == 1
+
+
+def test_split_resumed_path():
+    m_parser = ListParser(create_imports(random.Random(0), 20))
+    batches = generate_batches(m_parser, 10)
+    offset = batches[1].offsets[0]
+
+    # Resuming from an imported batch gives the same remaining batches
+    resumed_batches = generate_batches(m_parser, 10, offset=offset)
+    assert [b.offsets for b in resumed_batches] == [b.offsets for b in batches[1:]]
@@ -0,0 +1,75 @@
+import http.server
+import threading
+from pathlib import Path
+
+import pytest
+
+from finder.download import DownloadCache, download_file
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    # Serves one file with an ETag, supporting If-None-Match and ranges with If-Range
+    data = b''
+    etag = ''
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') is not None and self.headers.get('If-Range') == self.etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.data) - 1}/{len(self.data)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.data) - start))
+        self.end_headers()
+        self.wfile.write(self.data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    FileHandler.data = bytes(range(256)) * 100
+    FileHandler.etag = '"v1"'
+    FileHandler.requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/file.nc'
+    server.shutdown()
+
+
+def test_download(url: str, tmp_path: Path):
+    path = tmp_path / 'file.nc'
+    download_file(url, path)
+    assert path.read_bytes() == FileHandler.data
+
+    # Resume a part file
+    path.unlink()
+    (tmp_path / 'file.nc.part').write_bytes(FileHandler.data[:1000])
+    download_file(url, path)
+    assert path.read_bytes() == FileHandler.data
+    assert FileHandler.requests[-1]['Range'] == 'bytes=1000-'
+
+
+def test_refresh_cached_download_with_part_file(url: str, tmp_path: Path):
+    cache = DownloadCache(tmp_path / 'cache', None)
+    path = tmp_path / 'file.nc'
+    download_file(url, path, cache=cache)
+
+    # A part file left by an older version of the file isn't resumed with the validators of the cached download
+    path.unlink()
+    (tmp_path / 'file.nc.part').write_bytes(b'old' * 100)
+    (tmp_path / 'file.nc.validators.json').write_text('{"etag": "\\"v0\\""}')
+    download_file(url, path, refresh=True, cache=cache)
+    assert path.read_bytes() == FileHandler.data
+    assert not (tmp_path / 'file.nc.part').exists()
+    assert 'Range' not in FileHandler.requests[-1]
@@ -0,0 +1,37 @@
+import pytest
+
+from parser import ParsedImports
+
+
+def test_values_keep_their_type():
+    imports = ParsedImports(['value'])
+    for value in [1, 1.0, True, '1', 1]:
+        imports.append({'value': value})
+    assert [type(v) for v in imports.get_column('value')] == [int, float, bool, str, int]
+
+    extended = ParsedImports()
+    extended.extend(imports[2:])
+    assert list(extended) == [{'value': True}, {'value': '1'}, {'value': 1}]
+    assert [type(mdl['value']) for mdl in extended] == [bool, str, int]
+
+
+def test_unhashable_value():
+    imports = ParsedImports(['value'])
+    with pytest.raises(Exception, match='Unhashable value for import field value'):
+        imports.append({'value': [1]})
+
+
+def test_select_and_slice():
+    imports = ParsedImports(['site_code', 'value'])
+    for idx in range(10):
+        imports.append({'site_code': f's{idx % 3}', 'value': str(idx)})
+    assert list(imports.select([7, 2])) == [{'site_code': 's1', 'value': '7'}, {'site_code': 's2', 'value': '2'}]
+    assert list(imports[8:]) == [imports[8], imports[9]]
+    assert len(imports[3:6]) == 3
+
+
+def test_extend_empty():
+    imports = ParsedImports(['value'])
+    imports.append({'value': '1'})
+    imports.extend(ParsedImports())
+    assert list(imports) == [{'value': '1'}]
@@ -0,0 +1,87 @@
+import random
+from pathlib import Path
+from typing import List, Dict, Any
+
+import pytest
+
+from parser import BaseParser, ParsedImports
+
+key_fields = ['site_code', 'date', 'program', 'variant_type', 'variant_date_time', 'variant_value', 'variant_comment',
+              'parameter']
+
+
+# The original nested loop implementations, which the indexed implementations must match
+def ignore_zero_dups_nested(imports: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def is_zero_model(mdl: Dict[str, Any]):
+        return float(mdl['value']) == 0. and float(mdl['variant_value']) == 0.
+
+    zero_dup_idxs = set()
+    for idx_a, mdl_a in enumerate(imports):
+        for idx_b, mdl_b in enumerate(imports):
+            if idx_b >= idx_a:
+                break
+            if BaseParser._compare_models(mdl_a, mdl_b):
+                if is_zero_model(mdl_a):
+                    zero_dup_idxs.add(idx_a)
+                if is_zero_model(mdl_b):
+                    zero_dup_idxs.add(idx_b)
+
+    return [mdl for idx, mdl in enumerate(imports) if idx not in zero_dup_idxs]
+
+
+def ignore_dups_nested(imports: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    dup_idxs = set()
+    for idx_a, mdl_a in enumerate(imports):
+        for idx_b, mdl_b in enumerate(imports):
+            if idx_b >= idx_a:
+                break
+            if BaseParser._compare_models(mdl_a, mdl_b):
+                dup_idxs.add(idx_b)
+
+    return [mdl for idx, mdl in enumerate(imports) if idx not in dup_idxs]
+
+
+def create_imports(rng: random.Random, count: int) -> List[Dict[str, Any]]:
+    # Few distinct values per field, so there are many duplicates. The comment tells duplicates apart.
+    imports = []
+    for idx in range(count):
+        mdl = {f: rng.choice(['a', 'b']) for f in key_fields}
+        mdl['variant_value'] = rng.choice(['0', '0.0', '1.5'])
+        mdl['value'] = rng.choice(['0', '0.000', '2'])
+        mdl['comment'] = str(idx)
+        imports.append(mdl)
+    return imports
+
+
+def create_parser(imports: List[Dict[str, Any]]) -> BaseParser:
+    m_parser = BaseParser(Path('test'))
+    m_parser._imports = ParsedImports(key_fields + ['value', 'comment'])
+    for mdl in imports:
+        m_parser._imports.append(mdl)
+    return m_parser
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('count', [0, 1, 2, 50, 200])
+def test_ignore_zero_dups(seed: int, count: int):
+    imports = create_imports(random.Random(seed), count)
+    m_parser = create_parser(imports)
+    m_parser._ignore_zero_dups()
+    assert list(m_parser._imports) == ignore_zero_dups_nested(imports)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('count', [0, 1, 2, 50, 200])
+def test_ignore_dups(seed: int, count: int):
+    imports = create_imports(random.Random(seed), count)
+    m_parser = create_parser(imports)
+    m_parser._ignore_dups()
+    assert list(m_parser._imports) == ignore_dups_nested(imports)
+
+
+def test_ignore_dups_without_fields():
+    # Imports of a path without imports may have no fields
+    m_parser = BaseParser(Path('test'))
+    m_parser._ignore_zero_dups()
+    m_parser._ignore_dups()
+    assert len(m_parser._imports) == 0
@@ -0,0 +1,35 @@
+import queue
+import time
+
+import pytest
+
+import pipeline
+
+
+def test_threaded():
+    assert list(pipeline.threaded(range(100), maxsize=3)) == list(range(100))
+
+
+def test_threaded_raises():
+    def fail():
+        yield 1
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        list(pipeline.threaded(fail()))
+
+
+def test_threaded_last_item_after_stop(monkeypatch):
+    # The first wait times out just as the producer puts its last items and stops
+    get = queue.Queue.get
+    timed_out = []
+
+    def get_timing_out(self, block=True, timeout=None):
+        if timeout is not None and len(timed_out) == 0:
+            timed_out.append(True)
+            time.sleep(0.3)
+            raise queue.Empty
+        return get(self, block, timeout)
+
+    monkeypatch.setattr(queue.Queue, 'get', get_timing_out)
+    assert list(pipeline.threaded(iter([1]), maxsize=5)) == [1]
@@ -0,0 +1,23 @@
+from parser.template import TemplateCompiler
+
+
+def test_model_key():
+    template = TemplateCompiler({}).compile_template({'name': 'FIELD program', 'comment': 'FIELD comment | CONST x'})
+    key = template.get_model_key({'program': 'a', 'comment': 'b'})
+    assert key is not None
+    assert key == template.get_model_key({'program': 'a', 'comment': 'b', 'value': '1'})
+    assert template.get_model_key({'program': 1, 'comment': 'b'}) != template.get_model_key({'program': True,
+                                                                                             'comment': 'b'})
+
+
+def test_model_key_missing_field():
+    # A field missing from the model falls back to the CONST value, so the model can't be keyed
+    template = TemplateCompiler({}).compile_template({'name': 'FIELD program', 'comment': 'FIELD comment | CONST x'})
+    model_import = {'program': 'a'}
+    assert template.get_model_key(model_import) is None
+    assert template({'model_import': model_import}) == {'name': 'a', 'comment': 'x'}
+
+
+def test_model_key_unhashable_field():
+    template = TemplateCompiler({}).compile_template({'name': 'FIELD program'})
+    assert template.get_model_key({'program': ['a']}) is None
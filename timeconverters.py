@@ -1,11 +1,48 @@
 from datetime import datetime, timedelta
 
+import numpy
 from dateutil import parser
 
+epoch_1950 = numpy.datetime64('1950-01-01T00:00:00', 'us')
+microseconds_per_day = 24 * 60 * 60 * 1000000
+# Days since 1950 that can be represented by a datetime
+days_since_1950_min = (datetime.min - datetime(1950, 1, 1)).days
+days_since_1950_max = (datetime.max - datetime(1950, 1, 1)).days
+
 
 def convert_days_since_1950_to_datetime(days_since_1950: float) -> datetime:
     return datetime(1950, 1, 1) + timedelta(days_since_1950)
 
 
+def convert_days_since_1950_to_datetime64(days_since_1950: numpy.ndarray) -> numpy.ndarray:
+    # Values that can't be represented by a datetime are NaT.
+    # Split whole days and seconds from their fractions before rounding to microseconds, as timedelta does
+    days_since_1950 = numpy.asarray(days_since_1950, dtype=numpy.float64)
+    valid = numpy.isfinite(days_since_1950) & (days_since_1950 >= days_since_1950_min) \
+        & (days_since_1950 < days_since_1950_max)
+    days_since_1950 = numpy.where(valid, days_since_1950, 0.)
+    days = numpy.trunc(days_since_1950)
+    seconds = (days_since_1950 - days) * 86400.
+    whole_seconds = numpy.trunc(seconds)
+    microseconds = numpy.rint((seconds - whole_seconds) * 1000000.)
+    values = epoch_1950 + (days.astype(numpy.int64) * microseconds_per_day
+                           + whole_seconds.astype(numpy.int64) * 1000000
+                           + microseconds.astype(numpy.int64)).astype('timedelta64[us]')
+    return numpy.where(valid, values, numpy.datetime64('NaT'))
+
+
 def convert_bom_date_time_full_to_datetime(bom_date_time_full: str) -> datetime:
+    # BOM timestamps are YYYYMMDDhhmmss, so only parse other formats with dateutil
+    if len(bom_date_time_full) == 14 and bom_date_time_full.isdigit():
+        try:
+            return datetime(int(bom_date_time_full[0:4]), int(bom_date_time_full[4:6]), int(bom_date_time_full[6:8]),
+                            int(bom_date_time_full[8:10]), int(bom_date_time_full[10:12]),
+                            int(bom_date_time_full[12:14]))
+        except ValueError:
+            pass
     return parser.parse(bom_date_time_full)
+
+
+def format_datetime64_json(values: numpy.ndarray) -> numpy.ndarray:
+    # Truncate to seconds, as strftime does
+    return numpy.datetime_as_string(values.astype('datetime64[s]'), unit='s')